@@ -0,0 +1,209 @@
+#!/bin/python3
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+
+import numpy as np
+import skimage
+from PIL import Image
+
+from binarization import Parameters, binarize, compare_local_otsu, to_image
+
+# A4 page at 100, 200 and 300 dpi
+SIZES = ["827x1169", "1654x2339", "2480x3508"]
+BLOCK_SIZES = [25, 99, 349]
+METHODS = ["threshold", "otsu", "otsu_local", "otsu_local_fast", "adaptive", "adaptive_integral"]
+PHASES = ["decode", "grayscale", "threshold", "encode"]
+
+
+def synthetic_document(width, height, seed=0):
+    """Uneven lit paper with lines of dark word-like blocks, encoded as jpeg like real scans."""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    page = 200 + 30 * np.sin(x / (width / 3.0)) + 20 * np.cos(y / (height / 2.0))
+
+    line_height = max(height // 60, 4)
+    for top in range(line_height * 2, height - line_height * 2, line_height * 2):
+        left = width // 10
+        while left < width - width // 10:
+            word = rng.randint(line_height, line_height * 6)
+            page[top:top + line_height, left:left + word] -= rng.randint(80, 150)
+            left += word + line_height
+
+    page += rng.normal(0, 6, page.shape)
+    pixels = np.clip(page, 0, 255).astype(np.uint8)
+    rgb = np.stack([pixels, pixels, pixels], axis=2)
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgb).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def run_phases(data, parameter):
+    """Runs single conversion, returns seconds spent in every phase."""
+    timings = {}
+
+    start = time.perf_counter()
+    original = Image.open(io.BytesIO(data))
+    original.load()
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = np.array(original.convert('L'))
+    timings["grayscale"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    binary = binarize(image, parameter)
+    timings["threshold"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    to_image(binary, parameter).save(io.BytesIO(), format="PNG")
+    timings["encode"] = time.perf_counter() - start
+
+    return timings
+
+
+def memory_status(field):
+    """Field of /proc/self/status in bytes, VmRSS is current and VmHWM peak resident memory.
+       None where /proc isn't available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def _peak_memory_run(data, parameter):
+    baseline = memory_status("VmRSS")
+    if baseline is None:
+        # ru_maxrss is inherited from parent and survives exec, so only growth above it is seen
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run_phases(data, parameter)
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * (1024, 1)[sys.platform == "darwin"]
+    run_phases(data, parameter)
+    return memory_status("VmHWM") - baseline
+
+
+def peak_memory(data, parameter):
+    """Growth of peak resident memory during single conversion, measured in fresh process so that
+       PIL decode and encode buffers allocated in C are counted too and earlier runs don't hide it."""
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(_peak_memory_run, (data, parameter))
+
+
+def benchmark_parameters(methods, block_sizes):
+    for method in methods:
+        if method in ("adaptive", "adaptive_integral"):
+            for block_size in block_sizes:
+                yield Parameters(method, block_size=block_size)
+        else:
+            yield Parameters(method)
+
+
+def benchmark(sizes, methods, block_sizes, repeat):
+    results = []
+    for size in sizes:
+        width, height = [int(value) for value in size.split("x")]
+        data = synthetic_document(width, height)
+        for parameter in benchmark_parameters(methods, block_sizes):
+            # best of repeat runs, memory is measured in separate process
+            runs = [run_phases(data, parameter) for _ in range(repeat)]
+            timings = dict((phase, min(run[phase] for run in runs)) for phase in PHASES)
+            result = {
+                "method": parameter.type,
+                "width": width,
+                "height": height,
+                "block_size": parameter.block_size if parameter.type.startswith("adaptive") else None,
+                "seconds": timings,
+                "total": sum(timings.values()),
+                "peak_bytes": peak_memory(data, parameter),
+            }
+            print(f"{parameter.type:>18} {size:>10} block {str(result['block_size']):>4} "
+                  f"total {result['total']:8.3f}s threshold {timings['threshold']:8.3f}s "
+                  f"peak {result['peak_bytes'] / 2 ** 20:8.1f}MB")
+            results.append(result)
+    return results
+
+
+def benchmark_local_otsu(sizes):
+    """Agreement of fast local otsu with exact one, which it approximates."""
+    results = []
+    for size in sizes:
+        width, height = [int(value) for value in size.split("x")]
+        image = np.array(Image.open(io.BytesIO(synthetic_document(width, height))).convert('L'))
+        agreement, fast_time, exact_time = compare_local_otsu(image)
+        print(f"{'otsu_local_fast':>18} {size:>10} agrees with otsu_local on {agreement * 100:.2f}% of pixels, "
+              f"{fast_time:.3f}s vs {exact_time:.3f}s")
+        results.append({"width": width, "height": height, "agreement": agreement,
+                        "fast_seconds": fast_time, "exact_seconds": exact_time})
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result["method"], result["width"], result["height"], result["block_size"]
+
+
+def compare(baseline, results):
+    """Prints ratio of current to baseline total time and peak memory for matching entries."""
+    previous = dict((result_key(result), result) for result in baseline["results"])
+    print(f"Compared with {baseline['revision']}:")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        method, width, height, block_size = result_key(result)
+        print(f"{method:>18} {width}x{height} block {str(block_size):>4} "
+              f"time x{result['total'] / old['total']:.2f} memory x{result['peak_bytes'] / old['peak_bytes']:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thresholding methods on synthetic documents")
+    parser.add_argument("-s", "--sizes", nargs="+", help="image sizes WIDTHxHEIGHT", default=SIZES)
+    parser.add_argument("-m", "--methods", nargs="+", choices=METHODS, default=METHODS)
+    parser.add_argument("-b", "--block_sizes", nargs="+", type=int, default=BLOCK_SIZES)
+    parser.add_argument("-r", "--repeat", help="(default 3)", type=int, default=3)
+    parser.add_argument("-o", "--output", help="json result file", type=str, default="benchmark.json")
+    parser.add_argument("-c", "--compare", help="json result file of previous run", type=str)
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes, args.methods, args.block_sizes, args.repeat)
+    local_otsu = benchmark_local_otsu(args.sizes) if "otsu_local_fast" in args.methods else []
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "skimage": skimage.__version__,
+        "machine": platform.platform(),
+        "results": results,
+        "local_otsu": local_otsu,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved as: {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmark_binarization import git_revision
+
+ENTRY_POINTS = ["train", "owncloud_downloader", "renamer", "convex_hull", "merge_convex_hulls", "binarization",
+                "trim_learning_data", "thumbnail_label_gen", "dectector_net", "keras2tf", "keras_to_tf"]
+HEAVY_MODULES = ["tensorflow", "keras", "cv2", "matplotlib", "imagehash"]
+# what a command has to import before it starts working, measured for every entry point
+PROBE = "import sys, {module}; print(' '.join(name for name in {heavy} if name in sys.modules))"
+
+
+def import_once(module):
+    """Seconds spent starting interpreter and importing module in a fresh process,
+       with heavy modules which got loaded along the way."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                            cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    if output.returncode != 0:
+        return elapsed, None, output.stderr.decode().strip().splitlines()[-1]
+    return elapsed, output.stdout.decode().split(), None
+
+
+def benchmark(modules, repeat):
+    # interpreter alone, subtracted to show what the module itself costs
+    baseline = min(import_once("os")[0] for _ in range(repeat))
+    print(f"{'python':>20} {baseline:8.3f}s")
+    results = []
+    for module in modules:
+        runs = [import_once(module) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        _, loaded, error = runs[0]
+        result = {
+            "module": module,
+            "seconds": seconds,
+            "import_seconds": seconds - baseline,
+            "heavy_modules": loaded,
+            "error": error,
+        }
+        status = f"error {error}" if error is not None else f"loads {', '.join(loaded) or 'nothing heavy'}"
+        print(f"{module:>20} {seconds:8.3f}s import {result['import_seconds']:8.3f}s {status}")
+        results.append(result)
+    return baseline, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark startup time of command line entry points")
+    parser.add_argument("-m", "--modules", nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("-r", "--repeat", help="(default 5)", type=int, default=5)
+    parser.add_argument("-o", "--output", help="json result file", type=str, default="benchmark_startup.json")
+    args = parser.parse_args()
+
+    baseline, results = benchmark(args.modules, args.repeat)
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "interpreter_seconds": baseline,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved as: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
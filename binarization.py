@@ -1,6 +1,11 @@
 #!/bin/python3
 
 import argparse
+import os
+import time
+import warnings
+from contextlib import ExitStack
+from multiprocessing import Pool
 from pathlib import Path
 
 import numpy as np
@@ -9,20 +14,36 @@ from skimage.filters import threshold_otsu, threshold_local, rank
 from skimage.morphology import disk
 from tqdm import tqdm
 
-from utils.image import apply_rotation_from_original
+from utils.bitpack import BilevelPngWriter, BitPackWriter
+from utils.cache import ResultCache, cache_key, file_digest
+from utils.image import ROTATIONS, apply_rotation_from_original, exif_orientation
+
+OTSU_LOCAL_RADIUS = 15
+# fast local otsu is evaluated every OTSU_LOCAL_STEP pixels and interpolated in between. On synthetic pages
+# of benchmark_binarization it differs from exact otsu_local on 1% of pixels at 827x1169, 9% at 1654x2339
+# and 6% at 2480x3508, mostly background far from text, where exact otsu itself splits paper noise.
+# Smaller step doesn't fix that (step 4: 5% at 1654x2339, only 2x faster than rank.otsu)
+OTSU_LOCAL_STEP = 8
+# rough working set of thresholding in bytes per pixel (float64 copies made by filters)
+TILE_BYTES_PER_PIXEL = 48
 
 class Parameters:
-    def __init__(self, type, threshold=128, block_size=99, offset=5, suffix=False):
+    def __init__(self, type, threshold=128, block_size=99, offset=5, radius=OTSU_LOCAL_RADIUS, suffix=False):
         self.type = type
         self.threshold = threshold
         self.block_size = block_size
         self.offset = offset
+        self.radius = radius
         self._suffix = suffix
 
     @property
     def is_adaptive(self):
         return self.type == "adaptive"
 
+    @property
+    def is_adaptive_integral(self):
+        return self.type == "adaptive_integral"
+
     @property
     def is_otsu(self):
         return self.type == "otsu"
@@ -31,6 +52,10 @@ class Parameters:
     def is_otsu_local(self):
         return self.type == "otsu_local"
 
+    @property
+    def is_otsu_local_fast(self):
+        return self.type == "otsu_local_fast"
+
     @property
     def is_threshold(self):
         return self.type == "threshold"
@@ -41,10 +66,14 @@ class Parameters:
         if self._suffix is True:
             if self.is_adaptive:
                 return f"_a_{self.block_size}_{self.offset}"
+            elif self.is_adaptive_integral:
+                return f"_ai_{self.block_size}_{self.offset}"
             elif self.is_otsu:
                 return "_o"
             elif self.is_otsu_local:
-                return "_ol"
+                return "_ol" if self.radius == OTSU_LOCAL_RADIUS else f"_ol_{self.radius}"
+            elif self.is_otsu_local_fast:
+                return "_olf" if self.radius == OTSU_LOCAL_RADIUS else f"_olf_{self.radius}"
             else:
                 return f"_t_{self.threshold}"
         elif self._suffix is False:
@@ -52,14 +81,28 @@ class Parameters:
         else:
             return self._suffix
 
+    def as_dict(self):
+        return {
+            "type": self.type,
+            "threshold": self.threshold,
+            "block_size": self.block_size,
+            "offset": self.offset,
+            "radius": self.radius,
+            "suffix": self.suffix
+        }
+
     def __str__(self):
-        return f"<Paremeters type: {self.type}, threshold: {self.threshold}, block_size: {self.block_size}, offset: {self.offset}, suffix: {self.suffix}>"
+        return f"<Paremeters type: {self.type}, threshold: {self.threshold}, block_size: {self.block_size}, offset: {self.offset}, radius: {self.radius}, suffix: {self.suffix}>"
 
     @classmethod
     def from_args(cls, args):
         type = None
-        if args.adaptive:
+        if args.adaptive and args.integral:
+            type = "adaptive_integral"
+        elif args.adaptive:
             type = "adaptive"
+        elif args.local and args.fast:
+            type = "otsu_local_fast"
         elif args.local:
             type = "otsu_local"
         elif args.otsu:
@@ -67,13 +110,15 @@ class Parameters:
         else:
             type = "threshold"
 
-        return cls(type=type, threshold=args.threshold, block_size=args.block_size, offset=args.offset)
+        return cls(type=type, threshold=args.threshold, block_size=args.block_size, offset=args.offset,
+                   radius=args.radius)
 
 
 TRY_PARAMETERS = [
     Parameters("threshold", threshold=128, suffix=True),
     Parameters("otsu", suffix=True),
-    # Parameters("otsu_local", suffix=True),
+    # approximation of otsu_local (_ol), which is slow on big scans, see OTSU_LOCAL_STEP for how much they differ
+    Parameters("otsu_local_fast", suffix=True),
 
     Parameters("adaptive", block_size=25, offset=5, suffix=True),
     Parameters("adaptive", block_size=25, offset=10, suffix=True),
@@ -133,41 +178,403 @@ TRY_PARAMETERS = [
 ]
 
 
-def convert_to_bw(original, threshold):
-    gray = original.convert('L')
-    return gray.point(lambda x: 0 if x < threshold else 255, '1')
-
+def local_mean_integral(image, block_size):
+    """Mean of block_size x block_size window around every pixel computed from integral image.
+       Cost per pixel doesn't depend on block_size. Borders are mirrored the same way as in
+       threshold_local(method='mean')."""
+    if block_size % 2 == 0:
+        raise ValueError("The kwarg ``block_size`` must be odd! Given ``block_size`` {0} is even.".format(block_size))
+
+    radius = block_size // 2
+    padded = np.pad(image, radius, mode='symmetric')
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(padded, axis=0, dtype=np.int64), axis=1, out=integral[1:, 1:])
+
+    height, width = image.shape
+    window_sum = (integral[block_size:block_size + height, block_size:block_size + width]
+                  - integral[:height, block_size:block_size + width]
+                  - integral[block_size:block_size + height, :width]
+                  + integral[:height, :width])
+    return window_sum / float(block_size * block_size)
+
+
+def otsu_from_histograms(histograms):
+    """Otsu threshold for every row of (n, 256) histogram array, same rule as rank.otsu."""
+    histograms = histograms.astype(np.float64)
+    below = np.cumsum(histograms, axis=1)
+    below_sum = np.cumsum(histograms * np.arange(256), axis=1)
+    population, total = below[:, -1:], below_sum[:, -1:]
+    below, below_sum = below[:, :-1], below_sum[:, :-1]
+
+    # between class variance scaled by population, argmax is the same
+    variance = total * below
+    variance -= population * below_sum
+    variance *= variance
+    weights = population - below
+    weights *= below
+    np.maximum(weights, 1, out=weights)  # empty class has zero numerator anyway
+    variance /= weights
+
+    best = np.argmax(variance, axis=1)
+    return np.where(variance[np.arange(len(best)), best] > 0, best, 0).astype(np.uint8)
+
+
+def _sample_positions(size, step):
+    """Multiples of step covering [0, size), last one is moved back to the last pixel."""
+    positions = np.arange(0, size + step - 1, step)
+    positions[-1] = min(positions[-1], size - 1)
+    return positions
+
+
+def _interpolation(positions, size):
+    x = np.arange(size)
+    if len(positions) == 1:
+        index = np.zeros(size, dtype=np.intp)
+        return index, index, np.zeros(size, dtype=np.float32)
+    # positions are evenly spaced except the last one, which can be closer
+    index = np.minimum(x // (positions[1] - positions[0]), len(positions) - 2)
+    weight = (x - positions[index]) / (positions[index + 1] - positions[index])
+    return index, index + 1, weight.astype(np.float32)
+
+
+def local_otsu(image, radius=OTSU_LOCAL_RADIUS, step=OTSU_LOCAL_STEP):
+    """Otsu threshold of (2 * radius + 1) square window around pixels.
+       256 bin histogram of every window slides down the image, rows entering and leaving
+       the window are added and subtracted, so a row costs O(radius) per window.
+       Thresholds are computed on a grid of step pixels and interpolated bilinearly,
+       step=1 gives exactly rank.otsu with square footprint (but is slower than rank.otsu),
+       so the speed comes only from the sampling."""
+    height, width = image.shape
+    rows, columns = _sample_positions(height, step), _sample_positions(width, step)
+
+    left = np.clip(columns - radius, 0, width)
+    right = np.clip(columns + radius + 1, 0, width)
+    window_columns = np.concatenate([np.arange(l, r) for l, r in zip(left, right)])
+    window_owner = np.repeat(np.arange(len(columns)) * 256, right - left)
+
+    size = len(columns) * 256
+    histograms = np.zeros(size, dtype=np.int64)
+    grid = np.empty((len(rows), len(columns)), dtype=np.uint8)
+    top, bottom = 0, 0
+    for index, y in enumerate(rows):
+        new_top, new_bottom = min(max(0, y - radius), height), min(height, y + radius + 1)
+        for row in range(max(bottom, new_top), new_bottom):
+            histograms += np.bincount(window_owner + image[row, window_columns], minlength=size)
+        for row in range(top, min(new_top, bottom)):
+            histograms -= np.bincount(window_owner + image[row, window_columns], minlength=size)
+        top, bottom = new_top, new_bottom
+        grid[index] = otsu_from_histograms(histograms.reshape(len(columns), 256))
+
+    if step == 1:
+        return grid[:height, :width]
+
+    row_from, row_to, row_weight = _interpolation(rows, height)
+    column_from, column_to, column_weight = _interpolation(columns, width)
+    grid = grid.astype(np.float32)
+    horizontal = grid[:, column_from] * (1 - column_weight) + grid[:, column_to] * column_weight
+    return horizontal[row_from] * (1 - row_weight[:, None]) + horizontal[row_to] * row_weight[:, None]
+
+
+def compare_local_otsu(image, radius=OTSU_LOCAL_RADIUS, step=OTSU_LOCAL_STEP):
+    """Compares local_otsu with rank.otsu over disk, as used by exact otsu_local.
+       Returns fraction of pixels binarized the same way and both run times in seconds."""
+    start = time.perf_counter()
+    threshold = local_otsu(image, radius, step)
+    local_otsu_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = rank.otsu(image, disk(radius))
+    rank_otsu_time = time.perf_counter() - start
+
+    agreement = np.mean((image >= threshold) == (image >= reference))
+    return agreement, local_otsu_time, rank_otsu_time
+
+
+def local_mean(image, parameter):
+    if parameter.is_adaptive_integral:
+        return local_mean_integral(image, parameter.block_size)
+    return threshold_local(image, parameter.block_size, offset=0)
+
+
+def binarize(image, parameter):
+    """Thresholds grayscale array with single parameter set, returns boolean array."""
+    if parameter.is_otsu_local:
+        return image >= rank.otsu(image, disk(parameter.radius))
+    elif parameter.is_otsu_local_fast:
+        return image >= local_otsu(image, parameter.radius)
+    elif parameter.is_otsu:
+        return image >= threshold_otsu(image)
+    elif parameter.is_adaptive or parameter.is_adaptive_integral:
+        return image > local_mean(image, parameter) - parameter.offset
+    else:
+        return image >= parameter.threshold
 
-def convert_to_bw_otsu(original, local=False):
-    gray = original.convert('L')
-    threshold = rank.otsu(np.array(gray), disk(15)) if local else threshold_otsu(np.array(gray))
-    return Image.fromarray(np.uint8(gray >= threshold) * 255)
 
-def convert_to_bw_adaptive(original, block_size, offset):
-    gray = original.convert('L')
-    image = np.array(gray)
-    binary_adaptive = image > threshold_local(image, block_size, offset=offset)
-    return Image.fromarray(np.uint8(binary_adaptive) * 255)
+def binarize_all(image, parameters):
+    """Yields (parameter, binary) pairs for every parameter set.
+       Adaptive parameters sharing type and block_size differ only by constant offset,
+       so local mean is computed once per block_size and reused for each offset."""
+    by_block_size = {}
+    for parameter in parameters:
+        if parameter.is_adaptive or parameter.is_adaptive_integral:
+            by_block_size.setdefault((parameter.type, parameter.block_size), []).append(parameter)
+        else:
+            yield parameter, binarize(image, parameter)
+
+    for group in by_block_size.values():
+        mean = local_mean(image, group[0])
+        for parameter in group:
+            yield parameter, image > mean - parameter.offset
+
+
+def halo_rows(parameter):
+    """Number of neighbouring rows which affect threshold of a single row."""
+    if parameter.is_adaptive:
+        # threshold_local gaussian, sigma chosen by skimage, kernel truncated at 4 sigma
+        return int(4.0 * (parameter.block_size - 1) / 6.0 + 0.5)
+    elif parameter.is_adaptive_integral:
+        return parameter.block_size // 2
+    elif parameter.is_otsu_local:
+        return parameter.radius
+    elif parameter.is_otsu_local_fast:
+        # interpolation reaches up to the next grid row
+        return parameter.radius + OTSU_LOCAL_STEP
+    return 0
+
+
+def otsu_threshold_from_histogram(histogram):
+    """Otsu threshold for uint8 image given its 256 bin histogram, same result as threshold_otsu."""
+    values = np.flatnonzero(histogram)
+    if len(values) == 1:
+        return values[0]
+    low, high = values[0], values[-1] + 1
+    counts = histogram[low:high].astype(np.float64)
+    centers = np.arange(low, high)
+
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * centers) / weight1
+    mean2 = (np.cumsum((counts * centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return centers[np.argmax(variance12)]
+
+
+def strip_rows(width, halo, memory_limit):
+    """Rows of strip which fit memory_limit together with halo above and below. Strip is never
+       shorter than halo, otherwise every output row would be filtered again with the whole halo."""
+    rows = memory_limit // (width * TILE_BYTES_PER_PIXEL) - 2 * halo
+    minimum = max(1, halo)
+    if rows < minimum:
+        needed = (minimum + 2 * halo) * width * TILE_BYTES_PER_PIXEL
+        warnings.warn(f"Memory limit {memory_limit / 2 ** 20:.1f}MB can't hold {halo} halo rows of {width}px "
+                      f"wide image, strips will use about {needed / 2 ** 20:.1f}MB")
+    return max(minimum, rows)
+
+
+def binarize_all_tiled(image, parameters, memory_limit):
+    """Same as binarize_all, but thresholds image in horizontal strips extended by halo rows,
+       so working memory stays around memory_limit bytes and result matches full image exactly.
+       Yields (parameter, start, packed) as soon as strip is done, packed are np.packbits of binary
+       rows from row start on. Strips of every parameter come in order from the top."""
+    height, width = image.shape
+    for group in parameter_groups(parameters):
+        if any(parameter.is_otsu for parameter in group):
+            histogram = np.zeros(256, dtype=np.int64)
+            rows = strip_rows(width, 0, memory_limit)
+            for start in range(0, height, rows):
+                histogram += np.bincount(image[start:start + rows].ravel(), minlength=256)
+            otsu = otsu_threshold_from_histogram(histogram)
+            # global otsu is a plain threshold once computed over whole image
+            strip_parameters = [Parameters("threshold", threshold=otsu) if parameter.is_otsu else parameter
+                                for parameter in group]
+        else:
+            strip_parameters = group
+
+        halo = max(halo_rows(parameter) for parameter in group)
+        rows = strip_rows(width, halo, memory_limit)
+
+        for start in range(0, height, rows):
+            end = min(height, start + rows)
+            top, bottom = max(0, start - halo), min(height, end + halo)
+            # fast local otsu grid is anchored to multiples of OTSU_LOCAL_STEP
+            top -= top % OTSU_LOCAL_STEP
+            results = dict((id(parameter), binary) for parameter, binary
+                           in binarize_all(image[top:bottom], strip_parameters))
+            for parameter, strip_parameter in zip(group, strip_parameters):
+                binary = results[id(strip_parameter)][start - top:end - top]
+                yield parameter, start, np.packbits(binary, axis=1)
+
+
+def packed_to_image(packed, width):
+    return Image.frombytes('1', (width, packed.shape[0]), packed.tobytes())
+
+
+def to_image(binary, parameter):
+    if parameter.is_threshold:
+        return Image.fromarray(binary)
+    return Image.fromarray(np.uint8(binary) * 255)
+
+
+def output_path(file_path, parameter):
+    name = "".join([file_path.stem, parameter.suffix])
+    return file_path.with_name(f"{name}.png")
+
+
+def packed_output_path(file_path):
+    return file_path.with_name(f"{file_path.stem}.bwpack")
+
+
+def collect_strips(strips, height):
+    """Joins strips of binarize_all_tiled into whole packed images, yields (parameter, packed)."""
+    packed = {}
+    for parameter, start, rows in strips:
+        if id(parameter) not in packed:
+            packed[id(parameter)] = np.empty((height, rows.shape[1]), dtype=np.uint8)
+        packed[id(parameter)][start:start + len(rows)] = rows
+        if start + len(rows) == height:
+            yield parameter, packed.pop(id(parameter))
+
+
+def save_strips(file_path, strips, width, height, cache=None, keys=None):
+    """Writes strips of binarize_all_tiled to 1-bit pngs while they come, keys are cache keys by id of parameter."""
+    with ExitStack() as stack:
+        writers = {}
+        for parameter, start, packed in strips:
+            if id(parameter) not in writers:
+                writers[id(parameter)] = stack.enter_context(
+                    BilevelPngWriter(str(output_path(file_path, parameter)), width, height))
+            writer = writers[id(parameter)]
+            writer.write(packed)
+            if writer.rows == height:
+                writer.close()
+                if cache is not None:
+                    cache.put(keys[id(parameter)], output_path(file_path, parameter))
+
+
+def convert_and_save_all(file_path, parameters, memory_limit=None, pack=False, cache=None):
+    """Decodes and grayscales file once, then saves result for every parameter set.
+       With memory_limit (bytes) image is thresholded in strips and saved as 1-bit png.
+       With pack all results go to single bit packed container instead of separate pngs.
+       With cache (ResultCache) results already computed for the same source content and
+       parameters are restored from cache without decoding.
+       Returns exception raised on the way or None, so a single broken file doesn't stop the others."""
+    keys = {}
+    try:
+        if cache is not None:
+            digest = file_digest(str(file_path))
+            kind = "pack" if pack else "png" if memory_limit is None else "tiled"
+            if pack:
+                pack_key = cache_key(digest, kind, [parameter.as_dict() for parameter in parameters])
+                if cache.restore(pack_key, packed_output_path(file_path)):
+                    return None
+            else:
+                keys = dict((id(parameter), cache_key(digest, kind, parameter.as_dict())) for parameter in parameters)
+                parameters = [parameter for parameter in parameters
+                              if not cache.restore(keys[id(parameter)], output_path(file_path, parameter))]
+                if len(parameters) == 0:
+                    return None
+
+        with Image.open(str(file_path)) as original:
+            image = np.array(original.convert('L'))
+            height, width = image.shape
+            if pack:
+                if memory_limit is None:
+                    results = ((parameter, 0, np.packbits(binary, axis=1))
+                               for parameter, binary in binarize_all(image, parameters))
+                else:
+                    results = binarize_all_tiled(image, parameters, memory_limit)
+                layers = dict((id(parameter), index) for index, parameter in enumerate(parameters))
+                variants = [parameter.as_dict() for parameter in parameters]
+                new_file_path = packed_output_path(file_path)
+                with BitPackWriter(str(new_file_path), width, height, variants,
+                                   exif_orientation(original)) as writer:
+                    for parameter, start, packed in results:
+                        writer.write(layers[id(parameter)], packed, start)
+                if cache is not None:
+                    cache.put(pack_key, new_file_path)
+                return None
+
+            if memory_limit is not None and exif_orientation(original) not in ROTATIONS:
+                save_strips(file_path, binarize_all_tiled(image, parameters, memory_limit), width, height,
+                            cache, keys)
+                return None
+
+            if memory_limit is None:
+                results = ((parameter, to_image(binary, parameter))
+                           for parameter, binary in binarize_all(image, parameters))
+            else:
+                # rotation needs whole image, strips are collected first
+                results = ((parameter, packed_to_image(packed, width))
+                           for parameter, packed in collect_strips(binarize_all_tiled(image, parameters,
+                                                                                      memory_limit), height))
+            for parameter, bw in results:
+                bw = apply_rotation_from_original(original, bw)
+                new_file_path = output_path(file_path, parameter)
+                bw.save(str(new_file_path))
+                if cache is not None:
+                    cache.put(keys[id(parameter)], new_file_path)
+    except Exception as e:
+        # e.g. DecompressionBombError of huge scans or ValueError from skimage, reported with the file
+        return e
+    return None
 
 
 def convert_and_save(file_path, parameter):
-    try:
-        name = "".join([file_path.stem, parameter.suffix])
-        new_file_path = file_path.with_name(f"{name}.png")
-
-        file_name = str(file_path)
-        original = Image.open(file_name)
-        if parameter.is_otsu or parameter.is_otsu_local:
-            bw = convert_to_bw_otsu(original, parameter.is_otsu_local)
-        elif parameter.is_adaptive:
-            bw = convert_to_bw_adaptive(original, parameter.block_size, parameter.offset)
+    return convert_and_save_all(file_path, [parameter])
+
+
+def parameter_groups(parameters):
+    """Splits parameters into groups which can be processed independently
+       without computing the same local mean twice."""
+    groups = {}
+    for parameter in parameters:
+        if parameter.is_adaptive or parameter.is_adaptive_integral:
+            key = (parameter.type, parameter.block_size)
         else:
-            bw = convert_to_bw(original, parameter.threshold)
-        bw = apply_rotation_from_original(original, bw)
-        bw.save(str(new_file_path))
-        original.close()
-    except IOError:
-        pass
+            key = None
+        groups.setdefault(key, []).append(parameter)
+    return list(groups.values())
+
+
+def _convert_task(task):
+    file_path, parameters, memory_limit, pack, cache = task
+    return file_path, len(parameters), convert_and_save_all(file_path, parameters, memory_limit, pack, cache)
+
+
+def convert_directory(files, parameters, jobs=1, memory_limit=None, pack=False, cache=None):
+    """Converts every file with every parameter set, returns list of (file_path, error) failures.
+       With jobs > 1 (file, parameter group) tasks are distributed in chunks over process pool,
+       packed container is written by one task per file.
+       memory_limit (bytes) enables tiled mode, it applies to every worker separately.
+       cache (ResultCache) is trimmed to its size limit once all files are done."""
+    failures = {}
+    progress = tqdm(range(len(files) * len(parameters)), unit="file")
+
+    if jobs == 1:
+        tasks = ((file_path, parameters, memory_limit, pack, cache) for file_path in files)
+        results = map(_convert_task, tasks)
+        pool = None
+    else:
+        groups = [parameters] if pack else parameter_groups(parameters)
+        tasks = [(file_path, group, memory_limit, pack, cache) for file_path in files for group in groups]
+        pool = Pool(jobs)
+        chunk_size = max(1, len(tasks) // (jobs * 4))
+        results = pool.imap_unordered(_convert_task, tasks, chunk_size)
+
+    for file_path, count, error in results:
+        if error is not None:
+            failures.setdefault(file_path, error)
+        progress.update(count)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    progress.close()
+
+    if cache is not None:
+        cache.evict()
+
+    return list(failures.items())
 
 
 def main():
@@ -177,9 +584,25 @@ def main():
     parser.add_argument("-b", "--block_size", help="(default 99)", type=int, default=99)
     parser.add_argument("-o", "--offset", help="(default 5)", type=int, default=5)
     parser.add_argument("--otsu", action="store_true", help="otsu threshold")
-    parser.add_argument("--local", action="store_true", help="works only with --otsu (slower)")
+    parser.add_argument("--local", action="store_true", help="works only with --otsu, local otsu in disk (slower)")
+    parser.add_argument("--fast", action="store_true",
+                        help="works only with --otsu --local, approximation with square window evaluated every 8 pixels "
+                             "and interpolated, differs from exact on up to 9%% of pixels")
+    parser.add_argument("-r", "--radius", help="local otsu window radius (default 15)", type=int,
+                        default=OTSU_LOCAL_RADIUS)
     parser.add_argument("--adaptive", action="store_true", help="adaptive threshold")
+    parser.add_argument("--integral", action="store_true",
+                        help="works only with --adaptive, window mean from integral image (faster for big blocks)")
     parser.add_argument("--try", action="store_true", help="try different parameters")
+    parser.add_argument("-j", "--jobs", help="number of worker processes (default 1, 0 uses all cores)",
+                        type=int, default=1)
+    parser.add_argument("-m", "--memory", help="process image in strips using about MEMORY megabytes per worker",
+                        type=int, default=None)
+    parser.add_argument("--pack", action="store_true",
+                        help="store all results of image in single bit packed <name>.bwpack file")
+    parser.add_argument("--cache", help="directory of result cache, skips images converted before", type=str)
+    parser.add_argument("--cache_size", help="result cache limit in megabytes (default 1024)", type=int,
+                        default=1024)
     args = parser.parse_args()
 
     parameters = []
@@ -188,22 +611,19 @@ def main():
     else:
         parameters = [Parameters.from_args(args)]
 
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    memory_limit = args.memory * 1024 * 1024 if args.memory is not None else None
+    cache = ResultCache(args.cache, args.cache_size * 1024 * 1024) if args.cache is not None else None
+
     print("Converting to monochrome...")
     p = Path(args.path)
-    if p.is_dir():
-        listdir = list(p.iterdir())
-        progress = tqdm(range(len(listdir) * len(parameters)), unit="file")
-        for file_path in listdir:
-            for parameter in parameters:
-                convert_and_save(file_path, parameter)
-                progress.update()
-        progress.close()
-    else:
-        progress = tqdm(range(len(parameters)), unit="file")
-        for parameter in parameters:
-            convert_and_save(p, parameter)
-            progress.update()
-        progress.close()
+    files = list(p.iterdir()) if p.is_dir() else [p]
+    failures = convert_directory(files, parameters, jobs, memory_limit, args.pack, cache)
+
+    if len(failures) > 0:
+        print(f"* Failed to convert {len(failures)} file(s):")
+        for file_path, error in failures:
+            print(f"  {file_path}: {error}")
 
 
 if __name__ == "__main__":
@@ -3,38 +3,146 @@
 import argparse
 import os
 import fnmatch
-import warnings
-from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing import Pool
 
-from skimage import io, img_as_ubyte
-from skimage.morphology import convex_hull_image
+import numpy as np
+from PIL import Image
 from tqdm import tqdm
 
+from utils.image import save_mask
+from utils.rle import RunLengthMask
+
+LABEL_PATTERN = '*_label*[!lp].png'
+
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def monotone_chain(points):
+    """Convex hull of sorted unique points, counter clockwise without collinear vertices."""
+    if len(points) < 3:
+        return points
+
+    lower = []
+    for point in points:
+        while len(lower) >= 2 and _cross(lower[-2], lower[-1], point) <= 0:
+            lower.pop()
+        lower.append(point)
+
+    upper = []
+    for point in reversed(points):
+        while len(upper) >= 2 and _cross(upper[-2], upper[-1], point) <= 0:
+            upper.pop()
+        upper.append(point)
+
+    return lower[:-1] + upper[:-1]
+
+
+def boundary_points(mask):
+    """Edge midpoints of leftmost and rightmost foreground pixel of every row (the same points
+       convex_hull_image uses), in doubled coordinates, so everything stays integer."""
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return []
+    left = 2 * np.argmax(mask[rows], axis=1)
+    right = 2 * (mask.shape[1] - 1 - np.argmax(mask[rows, ::-1], axis=1))
+    rows = 2 * rows
+
+    xs = np.concatenate([left - 1, left, left, right + 1, right, right])
+    ys = np.concatenate([rows, rows - 1, rows + 1, rows, rows - 1, rows + 1])
+    return sorted(set(zip(xs.tolist(), ys.tolist())))
+
+
+def polygon_rows(vertices, shape):
+    """First and last column of pixels whose centre lies inside or on convex polygon given
+       in doubled coordinates, for every row. Empty rows have first > last."""
+    height, width = shape
+    left = np.full(height, np.inf)
+    right = np.full(height, -np.inf)
+
+    for (x0, y0), (x1, y1) in zip(vertices, vertices[1:] + vertices[:1]):
+        if y0 == y1:
+            continue
+        low, high = min(y0, y1), max(y0, y1)
+        rows = np.arange(max((low + 1) // 2, 0), min(high // 2, height - 1) + 1)
+        xs = x0 + (2 * rows - y0) * (x1 - x0) / (y1 - y0)
+        left[rows] = np.minimum(left[rows], xs)
+        right[rows] = np.maximum(right[rows], xs)
+
+    first = np.clip(np.ceil(left / 2), 0, width).astype(np.int64)
+    last = np.clip(np.floor(right / 2), -1, width - 1).astype(np.int64)
+    return first, last
+
+
+def rasterize_polygon(vertices, shape):
+    """Marks pixels whose centre lies inside or on convex polygon given in doubled coordinates."""
+    first, last = polygon_rows(vertices, shape)
+    columns = np.arange(shape[1])
+    return (columns >= first[:, None]) & (columns <= last[:, None])
+
+
+def convex_hull_mask(mask):
+    """Same as skimage convex_hull_image, but the hull is built only from row extremes
+       instead of every foreground pixel."""
+    vertices = monotone_chain(boundary_points(mask))
+    if len(vertices) == 0:
+        return np.zeros(mask.shape, dtype=bool)
+    return rasterize_polygon(vertices, mask.shape)
+
+
+def convex_hull_runs(mask):
+    """convex_hull_mask as RunLengthMask, hull rows are encoded directly without rasterizing."""
+    vertices = monotone_chain(boundary_points(mask))
+    if len(vertices) == 0:
+        return RunLengthMask.empty(mask.shape)
+    return RunLengthMask.from_rows(mask.shape, *polygon_rows(vertices, mask.shape))
+
+
+def load_foreground(file_name):
+    with Image.open(file_name) as original:
+        return np.array(original.convert('L')) == 0
+
+
+def load_convex_hull(file_name):
+    return convex_hull_mask(load_foreground(file_name))
+
+
+def load_convex_hull_runs(file_name):
+    return convex_hull_runs(load_foreground(file_name))
+
 
 def convert_and_save(file_name, new_file_name):
     try:
-        original = io.imread(file_name, as_grey=True)
-        convex_hull = convex_hull_image(original == 0)
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            io.imsave(new_file_name, img_as_ubyte(convex_hull))
+        save_mask(new_file_name, load_convex_hull(file_name))
     except IOError:
         pass
 
 
-def generate_convex_hull(source_dir, target_dir):
-    listdir = fnmatch.filter(os.listdir(source_dir), '*_label*[!lp].png')
+def _convert_task(task):
+    convert_and_save(*task)
+
+
+def list_labels(source_dir):
+    return fnmatch.filter(os.listdir(source_dir), LABEL_PATTERN)
+
+
+def convex_hull_file_name(file_name):
+    return file_name.replace('.png', '_convexhull.png')
+
+
+def generate_convex_hull(source_dir, target_dir, jobs=None):
+    listdir = list_labels(source_dir)
     progress = tqdm(range(len(listdir)), unit="file")
 
     target_dir = (source_dir, target_dir)[target_dir != None]
 
-    def convert(file_name):
-        new_file_name = file_name.replace('.png', '_convexhull.png')
-        convert_and_save(f"{source_dir}/{file_name}", f"{target_dir}/{new_file_name}")
-        progress.update()
+    tasks = [(f"{source_dir}/{file_name}", f"{target_dir}/{convex_hull_file_name(file_name)}")
+             for file_name in listdir]
 
-    pool = ThreadPool(4)
-    results = pool.map(convert, listdir)
+    pool = Pool(jobs)
+    for _ in pool.imap_unordered(_convert_task, tasks, chunksize=8):
+        progress.update()
     pool.close()
     pool.join()
 
@@ -45,10 +153,11 @@ def main():
     parser = argparse.ArgumentParser(description="Converts all images to convex hull images")
     parser.add_argument("dir", help="Source directory", type=str)
     parser.add_argument("target_dir", nargs='?', help="Target directory", type=str)
+    parser.add_argument("-j", "--jobs", help="number of worker processes (default all cores)", type=int)
     args = parser.parse_args()
 
     print("Converting to convex hull...")
-    generate_convex_hull(args.dir, args.target_dir)
+    generate_convex_hull(args.dir, args.target_dir, args.jobs)
 
 
 if __name__ == "__main__":
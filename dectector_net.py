@@ -2,92 +2,333 @@
 # !/bin/python3
 
 import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
 import numpy as np
-import tensorflow as tf
 from PIL import Image
-from matplotlib.image import imread
-from six.moves import cPickle as pickle
+
+from utils.lazy import lazy_import
+from utils.rle import RunLengthMask
+from utils.shards import ShardCache
+
+# heavy imports, loaded on first use so importing this module stays cheap
+tf = lazy_import("tensorflow")
+matplotlib = lazy_import("matplotlib")
+plt = lazy_import("matplotlib.pyplot")
+mpl_image = lazy_import("matplotlib.image")
+keras_to_tf = lazy_import("keras_to_tf")
+
+CACHE_DIR = "cache"
+PREVIEW_FILE = "preview.png"
+# images resized in one session run, decoded images waiting for their batch are limited to a few batches
+BATCH_SIZE = 32
+DECODE_WORKERS = os.cpu_count()
+PREFETCH_BATCHES = 2
+# random crops keep at least this fraction of image side
+MIN_CROP = 0.8
+
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_STEPS = 500
+EPOCHS = 50
+LEARNING_RATE = 1e-3
+# filters of U-Net levels, image side has to be divisible by 2 ** (levels - 1)
+MODEL_FILTERS = (16, 32, 64, 128)
+# ops are mostly large convolutions, which parallelize inside, input pipeline has its own map threads
+INTER_OP_THREADS = 2
+
+
+def cpu_count():
+    """Cores this process may run on, which is less than os.cpu_count() under affinity or cgroup sets."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def session_config(intra_op_threads=None, inter_op_threads=INTER_OP_THREADS):
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or cpu_count(),
+                          inter_op_parallelism_threads=inter_op_threads)
 
 
 class DetectorNet:
 
-    def __init__(self, data_path_list, label_path_list, img_size=256, cache=False):
+    def __init__(self, data_path_list, label_path_list, img_size=256, cache=False, cache_dir=CACHE_DIR,
+                 preload=True, preview=False):
         self.data_dir = data_path_list
         self.img_size = img_size
+        self.cache_dir = cache_dir
+        self._graphs = {}
         self.X, self.Y = None, None
 
-        if cache is True:
-            self.X, self.Y = self.load_from_cache()
+        # image and heatmap paths paired by hash, for input_pipeline
+        labels = dict((self._key(file_path), file_path) for file_path in label_path_list)
+        self.pairs = [(file_path, labels[self._key(file_path)]) for file_path in data_path_list
+                      if self._key(file_path) in labels]
+
+        if preload:
+            if cache is True:
+                self.X = self.load_cached(data_path_list, "data", 3, self.load_resized_data)
+                self.Y = self.load_cached(label_path_list, "labels", 1, self.load_resized_masks)
+            else:
+                self.X = self.load_resized_data(data_path_list)
+                self.Y = self.load_resized_masks(label_path_list)
+
+        if preview:
+            self.preview()
 
-        if self.X is None or self.Y is None:
-            self.X = self.load_resized_data(data_path_list)
-            self.Y = self.load_resized_data(label_path_list, channel_count=1, reshape=True)
-            self.write_cache()
+    def preview(self, file_name=None):
+        """Plots first image next to its resized heatmap. Plot is saved to file_name if it's given,
+           or to PREVIEW_FILE when there is no display, instead of blocking in plt.show."""
+        headless = sys.platform.startswith("linux") and not (os.environ.get("DISPLAY")
+                                                             or os.environ.get("WAYLAND_DISPLAY"))
+        file_name = (file_name, PREVIEW_FILE)[file_name is None and headless]
+        if file_name is not None:
+            matplotlib.use("Agg")
+
+        image_path, label_path = self.pairs[0]
+        key = self._key(image_path)
+        img = self.X[key] if self.X is not None else self.load_resized_data([image_path])[key]
+        lab = self.Y[key] if self.Y is not None else self.load_resized_masks([label_path])[key]
 
-        key, img = next(iter(self.X.items()))
-        img = img * 255
-        lab = self.Y[key].reshape(256, 256)
         fig, ax = plt.subplots(1, 2, sharey=True, sharex=True)
         ax1, ax2 = ax.ravel()
-        ax1.imshow(img)
-        ax2.imshow(lab, cmap="Greys")
+        ax1.imshow(np.clip(img, 0, 255).astype(np.uint8))
+        ax2.imshow(lab.reshape(self.img_size, self.img_size), cmap="Greys")
         ax1.axis('off')
         ax2.axis('off')
-        plt.show()
-
-    def train(self):
-        pass
-
-    def _loss(self):
-        pass
-
-    def get_augmentation(self, data):
-        pass
-
-    def load_from_cache(self):
-        if os.path.exists("X.pickle") and os.path.exists("Y.pickle"):
-            try:
-                X, Y = None, None
-                with open("X.pickle", "rb") as f:
-                    X = pickle.load(f)
-                with open("Y.pickle", "rb") as f:
-                    Y = pickle.load(f)
-                return X, Y
-            except Exception as e:
-                print("* Loading from cache failed")
-                return None, None
+        if file_name is None:
+            plt.show()
         else:
-            return None, None
-
-    def write_cache(self):
-        try:
-            with open('X.pickle', "wb") as f:
-                pickle.dump(self.X, f, pickle.HIGHEST_PROTOCOL)
-            with open('Y.pickle', "wb") as f:
-                pickle.dump(self.Y, f, pickle.HIGHEST_PROTOCOL)
-            return True
-        except Exception as e:
-            print("* Writing cache failed")
-            return False
-
-    def load_resized_data(self, dir_path, channel_count=3, reshape=False):
-        x_data = {}
-        tf.reset_default_graph()
-        X = tf.placeholder(tf.float32, (None, None, channel_count))
-        normalized = tf.image.per_image_standardization(X)
-        tf_img = tf.image.resize_images(X, (self.img_size, self.img_size),
-                                        tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+            fig.savefig(file_name)
+            print(f"+ Preview saved as: {file_name}")
+
+    def model(self, images):
+        """Small U-Net, returns sigmoid mask of the same size as images."""
+        x = images / 255.0
+        skips = []
+
+        def convolutions(x, filters):
+            x = tf.layers.conv2d(x, filters, 3, padding="same", activation=tf.nn.relu)
+            return tf.layers.conv2d(x, filters, 3, padding="same", activation=tf.nn.relu)
+
+        for filters in MODEL_FILTERS[:-1]:
+            x = convolutions(x, filters)
+            skips.append(x)
+            x = tf.layers.max_pooling2d(x, 2, 2)
+        x = convolutions(x, MODEL_FILTERS[-1])
+        for filters, skip in zip(reversed(MODEL_FILTERS[:-1]), reversed(skips)):
+            x = tf.layers.conv2d_transpose(x, filters, 2, strides=2, padding="same")
+            x = convolutions(tf.concat([x, skip], axis=-1), filters)
+        return tf.layers.conv2d(x, 1, 1, activation=tf.sigmoid, name="mask")
 
-        with tf.Session() as sess:
+    def train(self, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=LEARNING_RATE,
+              checkpoint_dir=CHECKPOINT_DIR, checkpoint_steps=CHECKPOINT_STEPS, intra_op_threads=None):
+        """Trains on input_pipeline, resuming from latest checkpoint in checkpoint_dir (interrupted
+           epoch starts over). Model is trained directly on pipeline tensors, time spent waiting on input
+           is taken from timestamps around the iterator inside the same run."""
+        graph = tf.Graph()
+        with graph.as_default():
+            iterator = self.input_pipeline(batch_size).make_initializable_iterator()
+            requested = tf.timestamp()
+            with tf.control_dependencies([requested]):
+                images, masks = iterator.get_next()
+            with tf.control_dependencies([images, masks]):
+                input_wait = tf.timestamp() - requested
+            batch_size_op = tf.shape(images)[0]
+            loss = self._loss(masks, self.model(images))
+
+            global_step = tf.train.get_or_create_global_step()
+            epoch = tf.Variable(0, trainable=False, name="epoch")
+            next_epoch = tf.assign_add(epoch, 1)
+            train_op = tf.train.AdamOptimizer(learning_rate).minimize(loss, global_step=global_step)
+            saver = tf.train.Saver(max_to_keep=3)
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_path = os.path.join(checkpoint_dir, "detector")
+        with tf.Session(graph=graph, config=session_config(intra_op_threads)) as sess:
             sess.run(tf.global_variables_initializer())
+            latest = tf.train.latest_checkpoint(checkpoint_dir)
+            if latest is not None:
+                saver.restore(sess, latest)
+                print(f"+ Resumed from {latest}")
+
+            for current_epoch in range(sess.run(epoch), epochs):
+                sess.run(iterator.initializer)
+                count, losses, wait, compute = 0, [], 0.0, 0.0
+                start = time.perf_counter()
+                while True:
+                    step_start = time.perf_counter()
+                    try:
+                        batch_loss, step, batch_wait, batch, _ = sess.run(
+                            [loss, global_step, input_wait, batch_size_op, train_op])
+                    except tf.errors.OutOfRangeError:
+                        break
+                    step_time = time.perf_counter() - step_start
+
+                    wait += batch_wait
+                    compute += max(step_time - batch_wait, 0.0)
+                    count += batch
+                    losses.append(batch_loss)
+                    if step % checkpoint_steps == 0:
+                        saver.save(sess, checkpoint_path, global_step=step)
 
-            for index, file_path in enumerate(dir_path):
-                img = imread(file_path)
-                img = img.reshape([img.shape[0], img.shape[1], channel_count]) if reshape else img
-                resized_img = sess.run(tf_img, feed_dict={X: img[:, :, :channel_count]})
-                key = file_path.split('/')[-1].split('.')[-2].replace('_heatmap', '')
+                sess.run(next_epoch)
+                saver.save(sess, checkpoint_path, global_step=sess.run(global_step))
+                elapsed = time.perf_counter() - start
+                steps = max(len(losses), 1)
+                print(f"+ Epoch {current_epoch + 1}/{epochs} loss {np.mean(losses):.4f} "
+                      f"{count / elapsed:.1f} images/s, step {1000 * (wait + compute) / steps:.0f} ms "
+                      f"(compute {1000 * compute / steps:.0f} ms, input wait {1000 * wait / steps:.0f} ms, "
+                      f"{100 * wait / max(elapsed, 1e-9):.0f}% of epoch)")
+
+    def _loss(self, masks, predictions):
+        return keras_to_tf.dice_coef_loss(masks, predictions)
+
+    def get_augmentation(self, image, mask):
+        """Random flips, quarter turns and crops, applied to image and mask together
+           so they stay aligned. Crops are resized back with nearest neighbor to keep mask binary."""
+        channels = image.shape[-1].value
+        data = tf.concat([image, mask], axis=-1)
+        data = tf.image.random_flip_left_right(data)
+        data = tf.image.random_flip_up_down(data)
+        data = tf.image.rot90(data, tf.random_uniform([], 0, 4, dtype=tf.int32))
+        crop = tf.cast(tf.random_uniform([], MIN_CROP, 1.0) * self.img_size, tf.int32)
+        data = tf.random_crop(data, tf.stack([crop, crop, channels + 1]))
+        data = tf.image.resize_images(data, (self.img_size, self.img_size), tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+        data.set_shape([self.img_size, self.img_size, channels + 1])
+        return data[:, :, :channels], data[:, :, channels:]
+
+    def _load_pair(self, image_path, mask_path, standardize=False):
+        """Same values as load_resized_data and load_resized_masks, decoded in graph."""
+        contents = tf.read_file(image_path)
+        # default jpeg dct is faster but differs from PIL behind load_resized_data by few levels
+        image = tf.cond(tf.image.is_jpeg(contents),
+                        lambda: tf.image.decode_jpeg(contents, channels=3, dct_method="INTEGER_ACCURATE"),
+                        lambda: tf.image.decode_png(contents, channels=3))
+        image.set_shape([None, None, 3])
+        image = tf.cast(image, tf.float32)
+        if standardize:
+            image = tf.image.per_image_standardization(image)
+        image = tf.image.resize_images(image, (self.img_size, self.img_size), tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+
+        mask = tf.image.decode_png(tf.read_file(mask_path), channels=1)
+        mask = tf.image.resize_images(mask, (self.img_size, self.img_size), tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+        mask = tf.cast(mask > 0, tf.float32)
+        return image, mask
+
+    def input_pipeline(self, batch_size=BATCH_SIZE, augment=True, shuffle=True, standardize=False):
+        """tf.data pipeline of (image, mask) batches built in current graph. Only paths are kept
+           in memory, pairs are read and decoded in parallel when they are needed and
+           next batches are prefetched while current one is used."""
+        image_paths, mask_paths = zip(*self.pairs)
+        dataset = tf.data.Dataset.from_tensor_slices((list(image_paths), list(mask_paths)))
+        if shuffle:
+            dataset = dataset.shuffle(len(self.pairs), reshuffle_each_iteration=True)
+        dataset = dataset.map(lambda image_path, mask_path: self._load_pair(image_path, mask_path, standardize),
+                              num_parallel_calls=DECODE_WORKERS)
+        if augment:
+            dataset = dataset.map(self.get_augmentation, num_parallel_calls=DECODE_WORKERS)
+        return dataset.batch(batch_size).prefetch(PREFETCH_BATCHES)
+
+    def load_cached(self, path_list, name, channel_count, load):
+        """Resized arrays as memory mapped view of shard cache, which is kept per image size and
+           channel count. Only files which are new or changed since they were cached go through
+           load(path_list), the rest isn't read until it's used."""
+        shape = (self.img_size, self.img_size, channel_count)
+        cache = ShardCache(f"{self.cache_dir}/{name}_{'x'.join(str(size) for size in shape)}", shape)
+        files = dict((self._key(file_path), file_path) for file_path in path_list)
+
+        stale = cache.stale(files)
+        if len(stale) > 0:
+            print(f"+ Caching {len(stale)} of {len(files)} {name} file(s)")
+            for key, array in load([files[key] for key in stale]).items():
+                cache.put(key, files[key], array)
+            cache.flush()
+        return cache.view(files.keys())
+
+    def _resize_graph(self, channel_count, standardize):
+        """Session with resize graph built once per channel count and standardization."""
+        key = (channel_count, standardize)
+        if key not in self._graphs:
+            graph = tf.Graph()
+            with graph.as_default():
+                X = tf.placeholder(tf.float32, (None, None, None, channel_count))
+                # standardization uses statistics of the whole image, so it runs before resize
+                images = tf.map_fn(tf.image.per_image_standardization, X) if standardize else X
+                tf_img = tf.image.resize_images(images, (self.img_size, self.img_size),
+                                                tf.image.ResizeMethod.NEAREST_NEIGHBOR)
+            self._graphs[key] = (tf.Session(graph=graph), X, tf_img)
+        return self._graphs[key]
+
+    @staticmethod
+    def _decode(file_path, channel_count, reshape):
+        img = mpl_image.imread(file_path)
+        img = img.reshape([img.shape[0], img.shape[1], channel_count]) if reshape else img
+        return img[:, :, :channel_count]
+
+    @staticmethod
+    def _decode_all(executor, path_list, decode, window):
+        """Decoded images in path_list order, at most window of them decoded ahead."""
+        pending = deque()
+        for file_path in path_list:
+            pending.append(executor.submit(decode, file_path))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+
+    def load_resized_data(self, dir_path, channel_count=3, reshape=False, standardize=False, batch_size=BATCH_SIZE):
+        """Images are decoded in parallel and resized batch_size at once, batches are made
+           of images of the same size. Graph and session are reused between calls."""
+        x_data = {}
+        sess, X, tf_img = self._resize_graph(channel_count, standardize)
+        buckets = {}
+
+        def run(batch):
+            keys, images = zip(*batch)
+            for key, resized_img in zip(keys, sess.run(tf_img, feed_dict={X: np.stack(images)})):
                 x_data[key] = resized_img
 
+        def decode(file_path):
+            return self._decode(file_path, channel_count, reshape)
+
+        with ThreadPoolExecutor(DECODE_WORKERS) as executor:
+            images = self._decode_all(executor, dir_path, decode, 2 * batch_size)
+            for file_path, img in zip(dir_path, images):
+                bucket = buckets.setdefault(img.shape, [])
+                bucket.append((self._key(file_path), img))
+                if len(bucket) == batch_size:
+                    run(buckets.pop(img.shape))
+                elif sum(len(bucket) for bucket in buckets.values()) >= 4 * batch_size:
+                    # too many different sizes, run partial batches instead of holding decoded images
+                    for bucket in buckets.values():
+                        run(bucket)
+                    buckets = {}
+
+        for bucket in buckets.values():
+            run(bucket)
         return x_data
+
+    def close(self):
+        for sess, _, _ in self._graphs.values():
+            sess.close()
+        self._graphs = {}
+
+    def load_label_masks(self, label_path_list):
+        """Whole label set as run length encoded masks, small enough to keep in memory."""
+        return {self._key(file_path): RunLengthMask.from_png(file_path) for file_path in label_path_list}
+
+    def load_resized_masks(self, label_path_list):
+        """Same result as load_resized_data(label_path_list, channel_count=1, reshape=True),
+           masks are resized in run length form and decoded only at target size."""
+        y_data = {}
+        for key, mask in self.load_label_masks(label_path_list).items():
+            resized = mask.resize_nearest(self.img_size, self.img_size).to_array()
+            y_data[key] = resized.astype(np.float32).reshape([self.img_size, self.img_size, 1])
+        return y_data
+
+    @staticmethod
+    def _key(file_path):
+        return file_path.split('/')[-1].split('.')[-2].replace('_heatmap', '')
@@ -2,11 +2,12 @@ import argparse
 import os
 from pathlib import Path
 
-import tensorflow as tf
-from keras import backend as K
-from keras.models import model_from_json, load_model
-from tensorflow.python.framework import graph_io
-from tensorflow.python.framework import graph_util
+from utils.graph_export import LATENCY_RUNS, QUANTIZATIONS, export
+from utils.lazy import lazy_import
+
+tf = lazy_import("tensorflow")
+K = lazy_import("keras.backend")
+keras_models = lazy_import("keras.models")
 
 MODEL_JSON_FILE = "./KR/model.json"
 WEIGHT_FILE = "./KR/weights.h5"
@@ -15,23 +16,24 @@ MODE_JSON = 0
 MODE_HDF5 = 1
 
 
-def convert_and_save(keras_model_path, weight_path, dry_run=None):
+def convert_and_save(keras_model_path, weight_path, dry_run=None, optimize=True, quantize=None, runs=LATENCY_RUNS):
     """Tries to open keras model (h5 or json format) and optionally applies weight from file.
-       Loaded model is saved as tensorflow compatible pb file."""
+       Loaded model is saved as tensorflow compatible pb file, optimized for inference unless optimize is False."""
     K.set_learning_phase(0)
     K.set_image_data_format('channels_last')
     name = Path(keras_model_path).name
     extension = name.split('.')[-1]
     if extension == "json":
         with open(keras_model_path, 'r') as f:
-            model = model_from_json('\n'.join(f.readlines()))
+            model = keras_models.model_from_json('\n'.join(f.readlines()))
     else:
-        model = load_model(keras_model_path)
+        model = keras_models.load_model(keras_model_path)
 
     if weight_path is not None:
         model.load_weights(weight_path)
 
     print("Found inputs: " + str(model.inputs))
+    input_node_names = [tensor.op.name for tensor in model.inputs]
 
     num_output = len(model.outputs)
     pred = [None] * num_output
@@ -52,8 +54,7 @@ def convert_and_save(keras_model_path, weight_path, dry_run=None):
         os.remove("./" + out_file_name)
 
     sess = K.get_session()
-    constant_graph = graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), pred_node_names)
-    graph_io.write_graph(constant_graph, ".", out_file_name, as_text=False)
+    export(sess, input_node_names, pred_node_names, ".", out_file_name, optimize, quantize, runs)
     print('Saved as: ', out_file_name)
 
 
@@ -65,10 +66,15 @@ def main():
     parser.add_argument("keras_model", help="Keras model file (json or h5)", type=str)
     parser.add_argument("weight_file", help="Additional weight file for model", type=str, default=None, nargs='?')
     parser.add_argument("--dry", help="Dry run, without saving output", type=bool)
+    parser.add_argument("--no_optimize", help="Save frozen graph as it is, with training nodes",
+                        action="store_true")
+    parser.add_argument("-q", "--quantize", help="Store weights with lower precision", choices=QUANTIZATIONS)
+    parser.add_argument("-r", "--runs", help=f"CPU latency runs, 0 skips measuring (default {LATENCY_RUNS})",
+                        type=int, default=LATENCY_RUNS)
 
     args = parser.parse_args()
 
-    convert_and_save(args.keras_model, args.weight_file, args.dry)
+    convert_and_save(args.keras_model, args.weight_file, args.dry, not args.no_optimize, args.quantize, args.runs)
 
 
 if __name__ == "__main__":
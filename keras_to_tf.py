@@ -1,14 +1,17 @@
 from pathlib import Path
 
-import tensorflow as tf
-from tensorflow.python.framework import graph_util
-from tensorflow.python.framework import graph_io
-from keras import backend as K
-from keras.models import load_model
+from utils.graph_export import export
+from utils.lazy import lazy_import
+
+tf = lazy_import("tensorflow")
+K = lazy_import("keras.backend")
+keras_models = lazy_import("keras.models")
 
 INPUT_FILE = "/home/mr3mpty/machine_learning/clothulhu.h5"
 OUTPUT_DIR = "/home/mr3mpty/machine_learning"
 OUTPUT_FILE = str(Path(INPUT_FILE).name).split('.')[0] + '.pb'
+# None keeps float32 weights, "float16" halves them, "int8" quarters them
+QUANTIZE = None
 
 
 def dice_coef(y_true, y_pred, smooth=0.9):
@@ -28,7 +31,7 @@ def main():
     K.set_image_data_format('channels_last')
 
     try:
-        model = load_model(INPUT_FILE, custom_objects={
+        model = keras_models.load_model(INPUT_FILE, custom_objects={
             'dice_coef_loss': dice_coef_loss,
             'dice_coef': dice_coef
         })
@@ -46,8 +49,8 @@ def main():
     print('output nodes names are: ', pred_node_names)
 
     sess = K.get_session()
-    constant_graph = graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), pred_node_names)
-    graph_io.write_graph(constant_graph, OUTPUT_DIR, OUTPUT_FILE, as_text=False)
+    input_node_names = [tensor.op.name for tensor in model.inputs]
+    export(sess, input_node_names, pred_node_names, OUTPUT_DIR, OUTPUT_FILE, quantize=QUANTIZE)
 
 
 if __name__ == "__main__":
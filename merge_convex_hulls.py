@@ -3,55 +3,129 @@
 import argparse
 import fnmatch
 import os
-import warnings
+from multiprocessing import Pool
 
-from skimage import io, img_as_ubyte
 from tqdm import tqdm
 
+import convex_hull
+from utils.rle import RunLengthMask
 
-def merge_and_save(convex_hull_file_name, heatmap_file_name):
+
+def heatmap_name(file_name):
+    return file_name.split('_', 1)[0] + '_heatmap.png'
+
+
+def merge_with_existing(merged_image, heatmap_file_name):
     try:
-        convex_hull_image = io.imread(convex_hull_file_name, as_grey=True)
-        merged_image = convex_hull_image != 0
+        merged_image = merged_image | RunLengthMask.from_png(heatmap_file_name)
+    except IOError:
+        pass
+    return merged_image
+
+
+def merge_masks_and_save(masks, heatmap_file_name, existing=True):
+    """ORs run length encoded masks without decoding them and writes heatmap once,
+       existing heatmap is merged in as well unless existing is False."""
+    masks = list(masks)
+    if len(masks) > 0:
+        merged_image = RunLengthMask.union(*masks)
+        if existing:
+            merged_image = merge_with_existing(merged_image, heatmap_file_name)
+        merged_image.to_png(heatmap_file_name)
+
+
+def _load_masks(file_names):
+    for file_name in file_names:
         try:
-            heatmap_image = io.imread(heatmap_file_name, as_grey=True)
-            merged_image = merged_image | (heatmap_image != 0)
+            yield RunLengthMask.from_png(file_name)
         except IOError:
             pass
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            io.imsave(heatmap_file_name, img_as_ubyte(merged_image))
+
+def _load_convex_hulls(label_file_names, convex_dir, hulls=None):
+    for label_file_name in label_file_names:
+        hull = None if hulls is None else hulls.get(os.path.basename(label_file_name))
+        if hull is None:
+            try:
+                hull = convex_hull.load_convex_hull_runs(label_file_name)
+            except IOError:
+                continue
+        if convex_dir is not None:
+            name = convex_hull.convex_hull_file_name(os.path.basename(label_file_name))
+            hull.to_png(f"{convex_dir}/{name}")
+        yield hull
+
+
+def merge_group_and_save(convex_hull_file_names, heatmap_file_name, existing=True):
+    merge_masks_and_save(_load_masks(convex_hull_file_names), heatmap_file_name, existing)
+
+
+def labels_to_heatmap(label_file_names, heatmap_file_name, convex_dir=None, hulls=None, existing=True):
+    """Builds convex hull of every label of one image in memory and writes merged heatmap once.
+       Convex hulls are saved to convex_dir only if it's given, hulls maps label file names
+       to already computed ones."""
+    merge_masks_and_save(_load_convex_hulls(label_file_names, convex_dir, hulls), heatmap_file_name, existing)
+
+
+def _merge_task(task):
+    function, arguments = task
+    try:
+        function(*arguments)
     except IOError:
         pass
+    return len(arguments[0])
 
 
-def merge_heatmap(source_path, target_path):
-    listdir = fnmatch.filter(os.listdir(source_path), '*_convexhull.png')
-    progress = tqdm(range(len(listdir)), unit="file")
-
-    target_dir = (source_path, target_path)[target_path != None]
+def _merge_groups(function, source_dir, file_names, target_dir, jobs, *arguments):
+    """Groups files by image hash and runs function(group, heatmap_file_name, *arguments)
+       for every group in process pool."""
+    groups = {}
+    for file_name in file_names:
+        groups.setdefault(heatmap_name(file_name), []).append(f"{source_dir}/{file_name}")
+    progress = tqdm(range(len(file_names)), unit="file")
 
-    def convert(file_name):
-        heatmap_file_name = file_name.split('_', 1)[0] + '_heatmap.png'
-        merge_and_save(f"{source_path}/{file_name}", f"{target_dir}/{heatmap_file_name}")
-        progress.update()
+    tasks = [(function, (sorted(group), f"{target_dir}/{name}") + arguments) for name, group in groups.items()]
 
-    for file_name in listdir:
-        convert(file_name)
+    pool = Pool(jobs)
+    for count in pool.imap_unordered(_merge_task, tasks):
+        progress.update(count)
+    pool.close()
+    pool.join()
 
     progress.close()
 
 
+def merge_heatmap(source_path, target_path, jobs=None):
+    """Every heatmap is read, merged with all its convex hulls and written exactly once."""
+    listdir = fnmatch.filter(os.listdir(source_path), '*_convexhull.png')
+    target_dir = (source_path, target_path)[target_path != None]
+    _merge_groups(merge_group_and_save, source_path, listdir, target_dir, jobs)
+
+
+def generate_heatmap_from_labels(labels_dir, heatmap_dir, convex_dir=None, jobs=None):
+    """Fused convex hull and merge stage, produces the same heatmaps as generate_convex_hull
+       followed by merge_heatmap without round trip through convex hull files."""
+    listdir = convex_hull.list_labels(labels_dir)
+    _merge_groups(labels_to_heatmap, labels_dir, listdir, heatmap_dir, jobs, convex_dir)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Merge convex hull images into heatmap")
     parser.add_argument("dir", help="Source directory", type=str)
     parser.add_argument("target_dir", nargs='?', help="Target directory", type=str)
+    parser.add_argument("--labels", action="store_true",
+                        help="source directory contains raw labels, convex hulls are built in memory")
+    parser.add_argument("--convex_dir", help="works only with --labels, also save convex hulls there", type=str)
+    parser.add_argument("-j", "--jobs", help="number of worker processes (default all cores)", type=int)
 
     args = parser.parse_args()
 
     print("Merging convex hulls into heatmaps...")
-    merge_heatmap(args.dir, args.target_dir)
+    if args.labels:
+        target_dir = (args.dir, args.target_dir)[args.target_dir != None]
+        generate_heatmap_from_labels(args.dir, target_dir, args.convex_dir, args.jobs)
+    else:
+        merge_heatmap(args.dir, args.target_dir, args.jobs)
 
 
 if __name__ == "__main__":
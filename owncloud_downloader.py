@@ -1,30 +1,73 @@
 #!/bin/python3
 
 import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import suppress
+from urllib import parse
 
 import owncloud
 import os
+import requests
 from tqdm import tqdm
 
+from utils.zipstream import iter_zip_entries
+
+RETRY_ERRORS = (owncloud.HTTPResponseError, requests.RequestException, IOError)
+PART_SUFFIX = ".part"
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_SAVE_INTERVAL = 100
+CHUNK_SIZE = 64 * 1024
+# one zip transfer is used for many small files, when most of directory is needed anyway
+ZIP_MIN_FILES = 100
+ZIP_MAX_AVERAGE_SIZE = 1024 * 1024
+ZIP_MIN_FRACTION = 0.5
+LAST_MODIFIED = "{DAV:}getlastmodified"
+
+
+def etag(file_info):
+    """Etag of file_info, None when server didn't send it."""
+    with suppress(KeyError):
+        return file_info.get_etag()
+    return None
+
 
 class Downloader:
 
-    def __init__(self, own_url, own_dir, out_dir, own_user=None, own_pass=None):
+    def __init__(self, own_url, own_dir, out_dir, own_user=None, own_pass=None, retries=3, backoff=1.0,
+                 client_factory=owncloud.Client):
         self.own_url = own_url
         self.own_dir = own_dir
         self.out_dir = out_dir
         self.own_user = own_user
         self.own_pass = own_pass
+        self.retries = retries
+        self.backoff = backoff
+        self.client_factory = client_factory
         self.oc = None
+        self._local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+
+    def _new_client(self):
+        oc = self.client_factory(self.own_url)
+        oc.login(self.own_user, self.own_pass)
+        return oc
 
     def connect(self):
-        self.oc = owncloud.Client(self.own_url)
-        self.oc.login(self.own_user, self.own_pass)
+        self.oc = self._new_client()
 
     def disconnect(self):
         if self.oc is not None:
             self.oc.logout()
+        with self._clients_lock:
+            for oc in self._clients:
+                with suppress(*RETRY_ERRORS):
+                    oc.logout()
+            self._clients = []
+        self._local = threading.local()
 
     def list(self):
         if self.oc is not None:
@@ -32,12 +75,232 @@ class Downloader:
         else:
             raise ConnectionError()
 
-    def download_zip(self):
-        self.oc.get_directory_as_zip(self.own_dir, self.out_dir)
+    def prefers_zip(self, file_list, listing):
+        """Zip of whole directory pays off for many small files when most of listing (of own_dir)
+           is going to be fetched. Zip holds whole subtree, so it isn't used when listing has subdirectories."""
+        if any(file_info.is_dir() for file_info in listing):
+            return False
+        file_list = [file_info for file_info in file_list if not file_info.is_dir()]
+        if len(file_list) < ZIP_MIN_FILES or len(file_list) < ZIP_MIN_FRACTION * len(listing):
+            return False
+        total = sum(file_info.get_size() or 0 for file_info in file_list)
+        return total / len(file_list) <= ZIP_MAX_AVERAGE_SIZE
+
+    def download_zip(self, file_list, done_callback=None, process=None):
+        """Streams own_dir as zip and extracts files from file_list while archive is coming in,
+           archive itself is never stored. Other entries are skipped. Callbacks are the same as
+           in download_files, both are called from calling thread.
+           Returns files which weren't extracted, e.g. because transfer broke."""
+        # same url as owncloud.Client.get_directory_as_zip, which can only save archive to file
+        remote_path = self.oc._normalize_path(self.own_dir)
+        url = self.oc.url + "index.php/apps/files/ajax/download.php?dir=" + parse.quote(remote_path)
+
+        # entries are named <own_dir name>/<file name>, deeper ones belong to subdirectories
+        prefix = os.path.basename(remote_path.rstrip("/"))
+        wanted = dict((f"{prefix}/{file_info.name}", file_info) for file_info in file_list if not file_info.is_dir())
+        progress = tqdm(total=sum(file_info.get_size() or 0 for file_info in wanted.values()),
+                        unit="B", unit_scale=True, unit_divisor=1024)
+
+        def expected_size(entry_name):
+            file_info = wanted.get(entry_name)
+            return None if file_info is None else file_info.get_size()
+
+        try:
+            response = self.oc._session.get(url, stream=True)
+            try:
+                if response.status_code >= 400:
+                    raise owncloud.HTTPResponseError(response)
+                for entry_name, data in iter_zip_entries(response.iter_content(CHUNK_SIZE), expected_size):
+                    file_info = wanted.get(entry_name)
+                    if file_info is None:
+                        continue
+                    local_path = f"{self.out_dir}/{file_info.name}"
+                    with open(local_path + PART_SUFFIX, "wb") as f:
+                        for chunk in data:
+                            f.write(chunk)
+                            progress.update(len(chunk))
+                    os.replace(local_path + PART_SUFFIX, local_path)
+                    del wanted[entry_name]
+                    if done_callback is not None:
+                        done_callback(file_info)
+                    if process is not None:
+                        process(local_path)
+            finally:
+                response.close()
+        except RETRY_ERRORS as error:
+            print(f"* Zip transfer stopped: {error}, {len(wanted)} file(s) left")
+        finally:
+            progress.close()
+        return list(wanted.values())
+
+    def transfer(self, file_list, workers=4, done_callback=None, process=None, listing=None):
+        """Fetches file_list with single zip transfer when prefers_zip, files it couldn't deliver
+           and everything else go through download_files. listing is whole own_dir listing,
+           file_list is taken for it by default. Returns failures of download_files."""
+        listing = file_list if listing is None else listing
+        if self.prefers_zip(file_list, listing):
+            file_list = self.download_zip(file_list, done_callback, process)
+        return self.download_files(file_list, workers, done_callback, process)
 
     def download_file(self, remote_path, file_name):
         self.oc.get_file(remote_path, f"{self.out_dir}/{file_name}")
 
+    def _worker_client(self):
+        """Logged in client of current worker thread, its session keeps connections alive between files."""
+        oc = getattr(self._local, "oc", None)
+        if oc is None:
+            oc = self._new_client()
+            self._local.oc = oc
+            with self._clients_lock:
+                self._clients.append(oc)
+        return oc
+
+    def _fetch(self, oc, file_info):
+        """Downloads file into .part file first. Part left by interrupted transfer is continued
+           with ranged request, If-Range (etag or modification date) makes server send whole file
+           if it has changed since. Without either of them part is downloaded again."""
+        local_path = f"{self.out_dir}/{file_info.name}"
+        part_path = local_path + PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = etag(file_info) or file_info.attributes.get(LAST_MODIFIED)
+
+        headers = {}
+        if offset > 0 and validator is not None:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        # same url as owncloud.Client.get_file, which can't send extra headers
+        remote_path = oc._normalize_path(file_info.path)
+        response = oc._session.get(oc._webdav_url + parse.quote(oc._encode_string(remote_path)),
+                                   headers=headers, stream=True)
+        try:
+            if response.status_code == 416:
+                os.remove(part_path)
+                raise IOError(f"Partial download of {file_info.path} is not valid anymore")
+            elif response.status_code >= 400:
+                raise owncloud.HTTPResponseError(response)
+
+            with open(part_path, "ab" if response.status_code == 206 else "wb") as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            response.close()
+
+        size = file_info.get_size()
+        if size is not None and os.path.getsize(part_path) != size:
+            raise IOError(f"Download of {file_info.path} is incomplete")
+        os.replace(part_path, local_path)
+
+    def _download_with_retry(self, file_info):
+        """Returns None on success or the last error once all retries failed."""
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(self._worker_client(), file_info)
+                return None
+            except RETRY_ERRORS as e:
+                if attempt == self.retries:
+                    return e
+                if isinstance(e, requests.ConnectionError):
+                    # session is broken, next attempt logs in again
+                    self._local.oc = None
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def _download_and_process(self, file_info, process):
+        error = self._download_with_retry(file_info)
+        if error is None and process is not None:
+            process(f"{self.out_dir}/{file_info.name}")
+        return error
+
+    def download_files(self, file_list, workers=4, done_callback=None, process=None):
+        """Downloads files with pool of workers, each one reusing its own authenticated connection.
+           Progress shows aggregate transfer rate. done_callback(file_info) is called from calling
+           thread for every finished file. process(local_path) is called from download worker
+           as soon as file is there, when it blocks downloads wait for it.
+           Returns list of (file_info, error) which failed after all retries."""
+        file_list = [file_info for file_info in file_list if not file_info.is_dir()]
+        total = sum(file_info.get_size() or 0 for file_info in file_list)
+        progress = tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024)
+        failures = []
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict((executor.submit(self._download_and_process, file_info, process), file_info)
+                           for file_info in file_list)
+            for future in as_completed(futures):
+                file_info = futures[future]
+                if future.result() is not None:
+                    failures.append((file_info, future.result()))
+                elif done_callback is not None:
+                    done_callback(file_info)
+                progress.update(file_info.get_size() or 0)
+
+        progress.close()
+        return failures
+
+    @property
+    def manifest_path(self):
+        return self.out_dir.rstrip("/") + MANIFEST_SUFFIX
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        temp_path = self.manifest_path + PART_SUFFIX
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def sync(self, workers=4, delete=False, process=None):
+        """Fetches only files which are new, changed remotely (different etag, or size and modification
+           time when server sends no etags) or missing locally.
+           Etag, size and modification time of every synced file are kept in manifest next to
+           out_dir. Files removed remotely are deleted locally with delete, otherwise just reported.
+           process is passed to transfer. Returns (fetched names, removed names, failures)."""
+        manifest = self.load_manifest()
+        listing = self.list()
+        remote = dict((file_info.name, file_info) for file_info in listing if not file_info.is_dir())
+
+        def changed(file_info):
+            entry = manifest.get(file_info.name)
+            if entry is None or entry["etag"] != etag(file_info):
+                return True
+            # without etag size and modification time have to do
+            if entry["etag"] is None and (entry["size"], entry["modified"]) != (
+                    file_info.get_size(), file_info.attributes.get(LAST_MODIFIED)):
+                return True
+            return not os.path.exists(f"{self.out_dir}/{file_info.name}")
+
+        stale = [file_info for file_info in remote.values() if changed(file_info)]
+        removed = sorted(name for name in manifest if name not in remote)
+        fetched = []
+
+        def record(file_info):
+            manifest[file_info.name] = {
+                "etag": etag(file_info),
+                "size": file_info.get_size(),
+                "modified": file_info.attributes.get(LAST_MODIFIED),
+            }
+            fetched.append(file_info.name)
+            if len(fetched) % MANIFEST_SAVE_INTERVAL == 0:
+                self.save_manifest(manifest)
+
+        try:
+            failures = self.transfer(stale, workers, record, process, listing)
+        finally:
+            self.save_manifest(manifest)
+
+        if delete:
+            for name in removed:
+                with suppress(FileNotFoundError):
+                    os.remove(f"{self.out_dir}/{name}")
+                del manifest[name]
+            self.save_manifest(manifest)
+
+        return fetched, removed, failures
+
     def __enter__(self):
         self.connect()
         return self
@@ -53,6 +316,9 @@ def main():
     parser.add_argument("output", help="output directory", type=str)
     parser.add_argument("-u", "--user", help="OwnCloud user", type=str)
     parser.add_argument("-p", "--passwd", help="OwnCloud user password", type=str)
+    parser.add_argument("-w", "--workers", help="parallel downloads (default 4)", type=int, default=4)
+    parser.add_argument("--sync", action="store_true", help="fetch only new and changed files")
+    parser.add_argument("--delete", action="store_true", help="works only with --sync, delete files removed remotely")
     args = parser.parse_args()
 
     downloader = Downloader(args.ownurl, args.owndir, args.output, args.user, args.passwd)
@@ -61,14 +327,16 @@ def main():
         with suppress(FileExistsError):
             os.mkdir(args.output)
 
-        file_list = d.list()
-        progress = tqdm(range(len(file_list)), unit="file")
-
-        for file_info in file_list:
-            d.download_file(file_info.path, file_info.name)
-            progress.update()
+        if args.sync:
+            fetched, removed, failures = d.sync(args.workers, args.delete)
+            print(f"+ Fetched {len(fetched)} file(s)")
+            for name in removed:
+                print(f"* {name} was removed remotely" + (", deleted" if args.delete else ""))
+        else:
+            failures = d.transfer(d.list(), args.workers)
 
-        progress.close()
+    for file_info, error in failures:
+        print(f"* Failed to download {file_info.path}: {error}")
 
 
 if __name__ == "__main__":
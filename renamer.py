@@ -1,70 +1,91 @@
 #!/bin/python3
 
 import argparse
-import imagehash
 import os
-import fnmatch
-import glob
-from multiprocessing.dummy import Pool as ThreadPool
+from multiprocessing import Pool
 
 from PIL import Image
 from tqdm import tqdm
 
-from utils.image import apply_rotation_from_original
+from utils.catalog import CATALOG_FILE, Catalog
+from utils.image import normalize_orientation
+from utils.lazy import lazy_import
 
-def rename(path, labels_path = None):
-    progress = tqdm(range(len(os.listdir(path))), unit="file")
+imagehash = lazy_import("imagehash")
 
-    def convert(file_name):
-        full_path = f"{path}/{file_name}"
-        extension = full_path.split(".")[-1]
-        file_name_without_extension = os.path.basename(file_name).split(".")[0]
+def convert(task):
+    """Returns (path, perceptual hash, list of (old path, new path) renames), hash is None for non images."""
+    full_path, labels, perceptual_hash = task
+    path = os.path.dirname(full_path)
+    extension = full_path.split(".")[-1]
+    file_name_without_extension = os.path.basename(full_path).split(".")[0]
+    renamed = []
 
-        # normalization and exif cleanup
-        try:
-            with Image.open(full_path) as img:
-                normalized = apply_rotation_from_original(img, img)
-
-                if img != normalized:
-                    print (f"{full_path} was normalized")
-                    exif = list(normalized.getdata())
-                    clean_image = Image.new(normalized.mode, normalized.size)
-                    clean_image.putdata(exif)
-                    clean_image.save(full_path)
-
-                perceptual_hash = imagehash.phash(normalized)
-                new_path = f"{path}/{perceptual_hash}.{extension.lower()}"
-
-                if new_path != full_path:
-                    print(f"renaming {full_path} to {new_path}")
-                    os.rename(full_path, new_path)
-
-                    if labels_path != None:
-                        for matching_filename in glob.iglob(f"{labels_path}/**/*{file_name_without_extension}*", recursive=True):
-                            renamed_file_name = matching_filename.replace(file_name_without_extension, f"{perceptual_hash}")
+    # normalization and exif cleanup
+    try:
+        if normalize_orientation(full_path):
+            print (f"{full_path} was normalized")
+            perceptual_hash = None
 
-                            if renamed_file_name != matching_filename:
-                                print(f"renaming match {matching_filename} to {renamed_file_name}")
-                                os.rename(matching_filename, renamed_file_name)
-
-        except IOError:
-            pass
-        progress.update()
-
-    pool = ThreadPool(4)
-    results = pool.map(convert, fnmatch.filter(os.listdir(path),'*.*'))
-    pool.close()
-    pool.join()
-
-    progress.close()
+        # hash from catalog is valid for files which haven't changed since
+        if not perceptual_hash:
+            with Image.open(full_path) as img:
+                perceptual_hash = str(imagehash.phash(img))
+        new_path = f"{path}/{perceptual_hash}.{extension.lower()}"
+
+        if new_path != full_path:
+            print(f"renaming {full_path} to {new_path}")
+            os.rename(full_path, new_path)
+            renamed.append((full_path, new_path))
+
+            for matching_filename in labels:
+                renamed_file_name = matching_filename.replace(file_name_without_extension, f"{perceptual_hash}")
+
+                if renamed_file_name != matching_filename:
+                    print(f"renaming match {matching_filename} to {renamed_file_name}")
+                    os.rename(matching_filename, renamed_file_name)
+                    renamed.append((matching_filename, renamed_file_name))
+
+    except IOError:
+        perceptual_hash = None
+    return full_path, perceptual_hash, renamed
+
+
+def rename(path, labels_path = None, jobs = None, catalog_path = CATALOG_FILE):
+    with Catalog(catalog_path) as catalog:
+        catalog.update(path, "image", "*.*", recursive=False, phash=False)
+        if labels_path != None:
+            catalog.update(labels_path, "label")
+
+        tasks = []
+        for entry in catalog.files("image", root=path):
+            # labels are matched by original file name, which is their hash only after first rename
+            stem = os.path.basename(entry.path).split(".")[0]
+            labels = [] if labels_path == None else [label.path for label in catalog.find("label", stem, labels_path)]
+            tasks.append((entry.path, labels, entry.phash))
+
+        progress = tqdm(range(len(tasks)), unit="file")
+        pool = Pool(jobs)
+        for full_path, perceptual_hash, renamed in pool.imap_unordered(convert, tasks):
+            for old_path, new_path in renamed:
+                catalog.move(old_path, new_path)
+            if perceptual_hash is not None:
+                catalog.add(renamed[0][1] if len(renamed) > 0 else full_path, "image", path, perceptual_hash)
+            progress.update()
+        pool.close()
+        pool.join()
+
+        progress.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description="Rename all files in directory with hash method")
     parser.add_argument("dir", help="Target directory", type=str)
     parser.add_argument("labels_dir", nargs='?', help="Labels directory", type=str)
+    parser.add_argument("-j", "--jobs", help="worker processes (default all cores)", type=int)
+    parser.add_argument("--catalog", help=f"(default {CATALOG_FILE})", type=str, default=CATALOG_FILE)
     args = parser.parse_args()
-    rename(args.dir, args.labels_dir)
+    rename(args.dir, args.labels_dir, args.jobs, args.catalog)
 
 
 if __name__ == "__main__":
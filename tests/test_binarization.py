@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from skimage.filters import rank, threshold_local
+from skimage.morphology import disk
+
+from binarization import OTSU_LOCAL_RADIUS, Parameters, binarize, local_mean_integral, local_otsu
+
+
+def noisy_page(height, width, seed=0):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    page = 180 + 40 * np.sin(x / 17.0) * np.cos(y / 23.0) + rng.normal(0, 20, (height, width))
+    return np.clip(page, 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("shape", [(64, 64), (37, 101), (120, 45)])
+@pytest.mark.parametrize("block_size", [3, 7, 25, 99])
+def test_local_mean_integral_matches_threshold_local(shape, block_size):
+    image = noisy_page(*shape)
+    reference = threshold_local(image, block_size, method='mean', offset=0)
+    np.testing.assert_allclose(local_mean_integral(image, block_size), reference, atol=1e-6)
+
+
+def test_local_mean_integral_rejects_even_block_size():
+    with pytest.raises(ValueError):
+        local_mean_integral(noisy_page(16, 16), 4)
+
+
+@pytest.mark.parametrize("shape", [(40, 40), (33, 70)])
+@pytest.mark.parametrize("radius", [2, 5])
+def test_local_otsu_step_1_matches_rank_otsu(shape, radius):
+    image = noisy_page(*shape)
+    square = np.ones((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    np.testing.assert_array_equal(local_otsu(image, radius, step=1), rank.otsu(image, square))
+
+
+def test_local_otsu_edges_use_image_windows():
+    # every window holds values 100-200 only, so no threshold can fall below 100
+    image = np.random.RandomState(1).randint(100, 201, (43, 61)).astype(np.uint8)
+    assert local_otsu(image, radius=2).min() >= 100
+
+
+def test_otsu_local_is_exact_rank_otsu_over_disk():
+    image = noisy_page(50, 60)
+    expected = image >= rank.otsu(image, disk(OTSU_LOCAL_RADIUS))
+    np.testing.assert_array_equal(binarize(image, Parameters("otsu_local")), expected)
@@ -0,0 +1,40 @@
+import os
+
+from utils.catalog import Catalog
+
+
+def touch(directory, *names):
+    for name in names:
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(name.encode())
+
+
+def test_same_directory_is_scanned_for_every_kind_and_pattern(tmp_path):
+    heatmaps = str(tmp_path / "heatmap")
+    touch(heatmaps, "a_heatmap.png", "b_heatmap.png", "a_label1.png")
+    with Catalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.update(heatmaps, "heatmap", "*_heatmap.png") == (2, 0)
+        assert catalog.update(heatmaps, "label", "*.png") == (3, 0)
+        assert catalog.hashes("label", heatmaps) == {"a", "b"}
+        assert catalog.hashes("heatmap", heatmaps) == {"a", "b"}
+        assert catalog.update(heatmaps, "heatmap", "*_heatmap.png") == (0, 0)
+        assert catalog.update(heatmaps, "label", "*.png") == (0, 0)
+
+
+def test_scans_with_different_pattern_and_recursion_keep_their_own_files(tmp_path):
+    data = str(tmp_path / "data")
+    touch(data, "x.jpg", "y.txt", "sub/z.jpg")
+    with Catalog(str(tmp_path / "catalog.sqlite")) as catalog:
+        assert catalog.update(data, "image", "*.*", recursive=False, phash=False) == (2, 0)
+        assert catalog.update(data, "image", "*.jpg", phash=False) == (1, 0)
+        names = sorted(os.path.relpath(entry.path, data) for entry in catalog.files("image", root=data))
+        assert names == ["sub/z.jpg", "x.jpg", "y.txt"]
+
+        os.remove(os.path.join(data, "sub", "z.jpg"))
+        os.remove(os.path.join(data, "y.txt"))
+        assert catalog.update(data, "image", "*.jpg", phash=False) == (0, 1)
+        assert catalog.update(data, "image", "*.*", recursive=False, phash=False) == (0, 1)
+        assert [os.path.basename(entry.path) for entry in catalog.files("image", root=data)] == ["x.jpg"]
+
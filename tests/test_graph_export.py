@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from utils.graph_export import fold_batch_norms, optimize_graph, run_graph, sample_inputs  # noqa: E402
+
+BATCH_NORM_OPS = ("FusedBatchNorm", "FusedBatchNormV3", "Mul", "Add", "AddV2", "Rsqrt")
+
+
+def batch_norm_graph(depthwise, bias, seed=0):
+    """Convolution, optional bias, inference batch norm and relu, the way Keras layers freeze."""
+    rng = np.random.RandomState(seed)
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, (None, 8, 8, 3), name="images")
+        if depthwise:
+            channels = 6
+            x = tf.nn.depthwise_conv2d(images, tf.constant(rng.rand(3, 3, 3, 2).astype(np.float32)),
+                                       [1, 1, 1, 1], "SAME")
+        else:
+            channels = 4
+            x = tf.nn.conv2d(images, tf.constant(rng.rand(3, 3, 3, 4).astype(np.float32)), [1, 1, 1, 1], "SAME")
+        if bias:
+            x = tf.nn.bias_add(x, tf.constant(rng.rand(channels).astype(np.float32)))
+        scale, offset, mean, variance = [tf.constant(rng.rand(channels).astype(np.float32) + 0.5) for _ in range(4)]
+        x = tf.nn.fused_batch_norm(x, scale, offset, mean, variance, is_training=False)[0]
+        tf.nn.relu(x, name="out")
+    return graph.as_graph_def()
+
+
+@pytest.mark.parametrize("depthwise", [False, True])
+@pytest.mark.parametrize("bias", [False, True])
+def test_batch_norm_is_folded_into_convolution(depthwise, bias):
+    graph_def = batch_norm_graph(depthwise, bias)
+    optimized = optimize_graph(graph_def, ["images"], ["out"])
+
+    assert not [node.op for node in optimized.node if node.op in BATCH_NORM_OPS]
+    inputs = sample_inputs(graph_def, ["images"], {"images": (2, 8, 8, 3)})
+    before = run_graph(graph_def, inputs, ["out"], runs=1)[0][0]
+    after = run_graph(optimized, inputs, ["out"], runs=1)[0][0]
+    np.testing.assert_allclose(after, before, atol=1e-5)
+
+
+def test_batch_norm_with_used_statistics_is_kept():
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, (None, 8, 8, 3), name="images")
+        x = tf.nn.conv2d(images, tf.ones((1, 1, 3, 2)), [1, 1, 1, 1], "SAME")
+        outputs = tf.nn.fused_batch_norm(x, tf.ones(2), tf.zeros(2), tf.zeros(2), tf.ones(2), is_training=False)
+        tf.add(outputs[0], tf.reduce_sum(outputs[1]), name="out")
+
+    folded = fold_batch_norms(graph.as_graph_def())
+    assert [node.op for node in folded.node if node.op.startswith("FusedBatchNorm")]
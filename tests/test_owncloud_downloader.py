@@ -0,0 +1,186 @@
+import os
+
+import owncloud
+import pytest
+
+from owncloud_downloader import PART_SUFFIX, ZIP_MIN_FILES, Downloader
+from webdav_server import WebDavStandIn
+
+FILE_COUNT = 40
+
+
+def write_file(path, size, seed):
+    data = os.urandom(size) if seed is None else bytes((seed + i * 7) % 256 for i in range(size))
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+@pytest.fixture
+def remote(tmp_path):
+    directory = tmp_path / "remote" / "set"
+    directory.mkdir(parents=True)
+    files = dict((f"{i:03d}.jpg", write_file(directory / f"{i:03d}.jpg", 1000 + 37 * i, i))
+                 for i in range(FILE_COUNT))
+    return directory, files
+
+
+def downloader(stand_in, out_dir, clients=None):
+    def client_factory(url):
+        client = owncloud.Client(url)
+        if clients is not None:
+            clients.append(client)
+        return client
+
+    return Downloader(stand_in.url, "set", str(out_dir), "user", "password", retries=6, backoff=0,
+                      client_factory=client_factory)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_files_retries_server_errors(tmp_path, remote):
+    directory, files = remote
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    clients = []
+    with WebDavStandIn(str(tmp_path / "remote"), fail_rate=0.1) as stand_in:
+        with downloader(stand_in, out_dir, clients) as d:
+            failures = d.download_files(d.list(), workers=4)
+
+    assert failures == []
+    assert stand_in.failures > 0
+    # one client listing and one per worker, reused for every file
+    assert len(clients) <= 5
+    for name, data in files.items():
+        assert read(out_dir / name) == data
+    assert not any(name.endswith(PART_SUFFIX) for name in os.listdir(out_dir))
+
+
+def test_download_files_reports_failures_after_retries(tmp_path, remote):
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with WebDavStandIn(str(tmp_path / "remote"), fail_rate=1.0) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            d.retries = 1
+            failures = d.download_files(d.list()[:3], workers=2)
+
+    assert len(failures) == 3
+    assert all(isinstance(error, owncloud.HTTPResponseError) for _, error in failures)
+
+
+@pytest.mark.parametrize("omit_etag", [False, True])
+def test_sync_fetches_only_changed_files(tmp_path, remote, omit_etag):
+    directory, files = remote
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with WebDavStandIn(str(tmp_path / "remote"), omit_etag=omit_etag) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            fetched, removed, failures = d.sync()
+        assert (sorted(fetched), removed, failures) == (sorted(files), [], [])
+
+        with downloader(stand_in, out_dir) as d:
+            assert d.sync() == ([], [], [])
+
+        changed = write_file(directory / "001.jpg", 5000, None)
+        added = write_file(directory / "new.jpg", 300, None)
+        os.remove(directory / "002.jpg")
+        with downloader(stand_in, out_dir) as d:
+            fetched, removed, failures = d.sync(delete=True)
+
+    assert (sorted(fetched), removed, failures) == (["001.jpg", "new.jpg"], ["002.jpg"], [])
+    assert read(out_dir / "001.jpg") == changed
+    assert read(out_dir / "new.jpg") == added
+    assert not os.path.exists(out_dir / "002.jpg")
+
+
+@pytest.mark.parametrize("omit_etag", [False, True])
+def test_partial_download_is_resumed(tmp_path, remote, omit_etag):
+    directory, files = remote
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    data = files["010.jpg"]
+    with open(out_dir / ("010.jpg" + PART_SUFFIX), "wb") as f:
+        f.write(data[:500])
+
+    with WebDavStandIn(str(tmp_path / "remote"), omit_etag=omit_etag) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            file_info = next(file_info for file_info in d.list() if file_info.name == "010.jpg")
+            assert d.download_files([file_info]) == []
+
+    assert stand_in.range_requests == [("010.jpg", "bytes=500-")]
+    assert read(out_dir / "010.jpg") == data
+
+
+def test_partial_download_restarts_when_file_changed(tmp_path, remote):
+    directory, files = remote
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with open(out_dir / ("010.jpg" + PART_SUFFIX), "wb") as f:
+        f.write(files["010.jpg"][:500])
+
+    with WebDavStandIn(str(tmp_path / "remote")) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            file_info = next(file_info for file_info in d.list() if file_info.name == "010.jpg")
+            # same size, so only If-Range can tell the part is from older version
+            changed = write_file(directory / "010.jpg", len(files["010.jpg"]), None)
+            file_info.attributes["{DAV:}getetag"] = '"stale"'
+            assert d.download_files([file_info]) == []
+
+    assert stand_in.range_requests == []
+    assert read(out_dir / "010.jpg") == changed
+
+
+@pytest.fixture
+def many_small_files(tmp_path):
+    directory = tmp_path / "remote" / "set"
+    directory.mkdir(parents=True)
+    files = dict((f"{i:03d}.jpg", write_file(directory / f"{i:03d}.jpg", 200 + i, i)) for i in range(ZIP_MIN_FILES))
+    return directory, files
+
+
+def test_sync_uses_zip_for_many_small_files(tmp_path, many_small_files):
+    directory, files = many_small_files
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with WebDavStandIn(str(tmp_path / "remote")) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            fetched, removed, failures = d.sync()
+
+    assert stand_in.zip_requests == 1
+    assert (sorted(fetched), failures) == (sorted(files), [])
+    for name, data in files.items():
+        assert read(out_dir / name) == data
+
+
+def test_zip_isnt_used_with_subdirectories(tmp_path, many_small_files):
+    directory, files = many_small_files
+    (directory / "00").mkdir()
+    write_file(directory / "00" / "000.jpg", 50, None)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with WebDavStandIn(str(tmp_path / "remote")) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            fetched, removed, failures = d.sync()
+
+    assert stand_in.zip_requests == 0
+    assert (sorted(fetched), failures) == (sorted(files), [])
+    assert read(out_dir / "000.jpg") == files["000.jpg"]
+
+
+def test_download_zip_skips_entries_of_subdirectories(tmp_path, many_small_files):
+    directory, files = many_small_files
+    # 00/000.jpg comes before 000.jpg in the archive
+    (directory / "00").mkdir()
+    write_file(directory / "00" / "000.jpg", 50, None)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    with WebDavStandIn(str(tmp_path / "remote")) as stand_in:
+        with downloader(stand_in, out_dir) as d:
+            left = d.download_zip(d.list())
+
+    assert left == []
+    for name, data in files.items():
+        assert read(out_dir / name) == data
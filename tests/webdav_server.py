@@ -0,0 +1,147 @@
+import email.utils
+import hashlib
+import http.server
+import io
+import os
+import random
+import threading
+import zipfile
+from urllib import parse
+
+CAPABILITIES = (b'<?xml version="1.0"?><ocs><meta><status>ok</status><statuscode>100</statuscode><message/></meta>'
+                b'<data><version><string>10.0</string><edition/></version><capabilities><core/></capabilities>'
+                b'</data></ocs>')
+WEBDAV_PATH = "remote.php/webdav"
+
+
+def file_etag(path):
+    stat = os.stat(path)
+    return '"' + hashlib.md5(f"{stat.st_mtime_ns}:{stat.st_size}".encode()).hexdigest() + '"'
+
+
+def last_modified(path):
+    return email.utils.formatdate(os.stat(path).st_mtime, usegmt=True)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def stand_in(self):
+        return self.server.stand_in
+
+    def _send(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _local_path(self):
+        path = parse.unquote(parse.urlparse(self.path).path)
+        return os.path.join(self.stand_in.root, path.split(WEBDAV_PATH, 1)[1].lstrip("/"))
+
+    def _zip(self):
+        directory = os.path.join(self.stand_in.root, parse.unquote(self.path.split("dir=", 1)[1]).lstrip("/"))
+        prefix = os.path.basename(directory.rstrip("/"))
+        buffer = io.BytesIO()
+        paths = [os.path.relpath(os.path.join(parent, name), directory)
+                 for parent, _, names in os.walk(directory) for name in names]
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for path in sorted(paths):
+                archive.write(os.path.join(directory, path), prefix + "/" + path)
+        self.stand_in.zip_requests += 1
+        self._send(200, buffer.getvalue(), [("Content-Type", "application/zip")])
+
+    def do_GET(self):
+        if "capabilities" in self.path:
+            return self._send(200, CAPABILITIES)
+        if "download.php" in self.path:
+            return self._zip()
+        if self.stand_in.fail():
+            return self._send(500, b"Internal Server Error")
+
+        path = self._local_path()
+        if not os.path.isfile(path):
+            return self._send(404)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        ranges = self.headers.get("Range")
+        validator = self.headers.get("If-Range")
+        if ranges is not None and validator in (None, file_etag(path), last_modified(path)):
+            self.stand_in.range_requests.append((os.path.basename(path), ranges))
+            start = int(ranges.split("=")[1].split("-")[0])
+            if start >= len(data):
+                return self._send(416)
+            return self._send(206, data[start:], [("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")])
+        self._send(200, data)
+
+    def do_PROPFIND(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        directory = self._local_path()
+        if not os.path.isdir(directory):
+            return self._send(404)
+        base = parse.urlparse(self.path).path.rstrip("/") + "/"
+        entries = [(base, directory)]
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            # clients tell directories by trailing slash of href
+            entries.append((base + parse.quote(name) + ("", "/")[os.path.isdir(path)], path))
+
+        responses = []
+        for href, path in entries:
+            properties = f"<d:getlastmodified>{last_modified(path)}</d:getlastmodified>"
+            if not self.stand_in.omit_etag:
+                properties += f"<d:getetag>{file_etag(path).replace(chr(34), '&quot;')}</d:getetag>"
+            if os.path.isdir(path):
+                properties += "<d:resourcetype><d:collection/></d:resourcetype>"
+            else:
+                properties += (f"<d:resourcetype/><d:getcontentlength>{os.path.getsize(path)}</d:getcontentlength>"
+                               f"<d:getcontenttype>application/octet-stream</d:getcontenttype>")
+            responses.append(f"<d:response><d:href>{href}</d:href><d:propstat><d:prop>{properties}</d:prop>"
+                             f"<d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>")
+        body = '<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">' + "".join(responses) + "</d:multistatus>"
+        self._send(207, body.encode(), [("Content-Type", "application/xml")])
+
+
+class WebDavStandIn:
+    """Local stand-in of ownCloud serving files under root: login, PROPFIND listing, ranged GET
+       with If-Range and zip of directory. fail_rate of file downloads end with HTTP 500,
+       omit_etag leaves etags out of listing."""
+
+    def __init__(self, root, fail_rate=0.0, omit_etag=False, seed=0):
+        self.root = root
+        self.fail_rate = fail_rate
+        self.omit_etag = omit_etag
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.zip_requests = 0
+        self.range_requests = []
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.stand_in = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def fail(self):
+        with self.lock:
+            failed = self.random.random() < self.fail_rate
+            self.failures += failed
+            return failed
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
@@ -4,7 +4,9 @@ import fnmatch
 import os
 import pathlib
 
-import cv2
+from utils.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
 
 
 def files_recursively(dir_path, pattern="*.png"):
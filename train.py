@@ -1,17 +1,20 @@
+import argparse
+import fnmatch
 import os
-import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
-from multiprocessing.dummy import Pool as ThreadPool
 
-from PIL import Image
 from PIL import ImageFile
-from tqdm import tqdm
 
 import convex_hull
 import merge_convex_hulls
 from dectector_net import DetectorNet
 from owncloud_downloader import Downloader
-from utils.image import apply_rotation_from_original
+from utils.build import BuildGraph
+from utils.catalog import Catalog
+from utils.image import normalize_orientation
+from utils.pipeline import ProcessingQueue
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -25,44 +28,50 @@ DATA_DIR = "data"
 LABELS_DIR = "raw_labels"
 CONVEX_DIR = "convex"
 HEATMAP_DIR = "heatmap"
+# inputs every derived file was built from, to rebuild it when some of them appear or disappear
+BUILD_STATE = ".build_state.json"
+# index of data, labels and heatmaps by image hash
+CATALOG_FILE = "catalog.sqlite"
 
 IMAGE_SIZE = 128
-
-
-def dir_exists(path):
-    if os.path.isdir(path) and len(os.listdir(path)) > 0:
-        return True
-    else:
-        return False
-
-
-def download(own_dir, local_dir):
+DOWNLOAD_WORKERS = 8
+# delete local files which were removed from ownCloud
+SYNC_DELETE = False
+# intermediate convex hulls aren't needed for training, heatmaps are built from labels in memory
+WRITE_CONVEX_HULLS = False
+# processes normalizing and generating hulls while downloading, None uses all cores
+PROCESS_WORKERS = None
+STAGES = ["download", "train"]
+
+
+def download(own_dir, local_dir, process=None):
+    """Syncs local_dir with own_dir, returns names of files fetched in this run.
+       process(local_path) is called for every fetched file while others are still downloading."""
     downloader = Downloader(OWN_URL, own_dir, local_dir, OWN_USER, OWN_PWD)
 
     with downloader as d:
         with suppress(FileExistsError):
             os.mkdir(local_dir)
 
-        file_list = d.list()
-        progress = tqdm(range(len(file_list)), unit="file")
+        fetched, removed, failures = d.sync(DOWNLOAD_WORKERS, delete=SYNC_DELETE, process=process)
 
-        for file_info in file_list:
-            d.download_file(file_info.path, file_info.name)
-            progress.update()
+    print(f" + Fetched {len(fetched)} new or changed file(s) to {local_dir}")
+    for name in removed:
+        print(f" * {name} was removed remotely" + (", deleted" if SYNC_DELETE else ""))
+    for file_info, error in failures:
+        print(f"* Failed to download {file_info.path}: {error}")
 
-        progress.close()
+    return fetched
 
 
-def data_vs_labels_validation():
-    label_set = set()
-    data_set = set()
+def data_vs_labels_validation(catalog):
     missing_set = set()
     valid_set = set()
 
-    for file in os.listdir(LABELS_DIR):
-        label_set.add(file.split('_')[0])
-    for file in os.listdir(DATA_DIR):
-        data_set.add(file.split('.')[0])
+    catalog.update(DATA_DIR, "image", "*.jpg")
+    catalog.update(LABELS_DIR, "label", "*.png")
+    data_set = catalog.hashes("image", DATA_DIR)
+    label_set = catalog.hashes("label", LABELS_DIR)
 
     print("+ Data vs label size same: %r" % (len(label_set) == len(data_set)))
     for data in data_set:
@@ -79,84 +88,116 @@ def data_vs_labels_validation():
     return valid_set
 
 
-def generate_convex_hull():
-    with suppress(FileExistsError):
-        os.mkdir(CONVEX_DIR)
-    convex_hull.generate_convex_hull(LABELS_DIR, CONVEX_DIR)
+def normalize_file(full_path):
+    try:
+        normalize_orientation(full_path)
+    except IOError:
+        pass
+
+
+def label_convex_hull(file_path):
+    """Returns (file name, convex hull run length mask) of label, mask is None for other files."""
+    file_name = os.path.basename(file_path)
+    if not fnmatch.fnmatch(file_name, convex_hull.LABEL_PATTERN):
+        return file_name, None
+    return file_name, convex_hull.load_convex_hull_runs(file_path)
+
+
+def build_graph(hulls=None):
+    """Rules of files derived from labels. Heatmap of an image depends on all its labels,
+       or on their convex hulls with WRITE_CONVEX_HULLS, and is always built from scratch.
+       hulls maps label file names to convex hulls computed while downloading."""
+    hulls = {} if hulls is None else hulls
+    graph = BuildGraph(BUILD_STATE)
+    groups = defaultdict(list)
+    for file_name in convex_hull.list_labels(LABELS_DIR):
+        label_path = f"{LABELS_DIR}/{file_name}"
+        if WRITE_CONVEX_HULLS:
+            hull_path = f"{CONVEX_DIR}/{convex_hull.convex_hull_file_name(file_name)}"
+            graph.add([hull_path], [label_path], convex_hull.convert_and_save, label_path, hull_path)
+            groups[merge_convex_hulls.heatmap_name(file_name)].append(hull_path)
+        else:
+            groups[merge_convex_hulls.heatmap_name(file_name)].append(label_path)
 
+    for heatmap_file_name, inputs in groups.items():
+        heatmap_path = f"{HEATMAP_DIR}/{heatmap_file_name}"
+        inputs = sorted(inputs)
+        if WRITE_CONVEX_HULLS:
+            graph.add([heatmap_path], inputs, merge_convex_hulls.merge_group_and_save, inputs, heatmap_path, False)
+        else:
+            known = dict((os.path.basename(path), hulls[os.path.basename(path)])
+                         for path in inputs if os.path.basename(path) in hulls)
+            graph.add([heatmap_path], inputs, merge_convex_hulls.labels_to_heatmap,
+                      inputs, heatmap_path, None, known, False)
+    return graph
 
-def generate_heatmap():
-    with suppress(FileExistsError):
-        os.mkdir(HEATMAP_DIR)
-    merge_convex_hulls.merge_heatmap(CONVEX_DIR, HEATMAP_DIR)
 
+def build_derived(hulls):
+    print("+ Rebuilding stale convex hulls and heatmaps")
+    for path in (CONVEX_DIR, HEATMAP_DIR)[not WRITE_CONVEX_HULLS:]:
+        with suppress(FileExistsError):
+            os.mkdir(path)
+    built, failures = build_graph(hulls).build(PROCESS_WORKERS)
+    print(f" + Built {built} file(s)")
+    for outputs, error in failures:
+        print(f"* Failed to build {', '.join(outputs)}: {error}")
 
-def normalize_rotation(path):
-    progress = tqdm(range(len(os.listdir(path))), unit="file")
 
-    def normalize(file_name):
-        full_path = f"{path}/{file_name}"
-        try:
-            with Image.open(full_path) as img:
-                normalized = apply_rotation_from_original(img, img)
-                exif = list(normalized.getdata())
-                clean_image = Image.new(normalized.mode, normalized.size)
-                clean_image.putdata(exif)
-                clean_image.save(full_path)
-        except IOError:
-            pass
-        progress.update()
+def download_data():
+    """Syncs data and labels at the same time. Fetched files are processed while the rest is downloading,
+       downloads wait when processing falls behind. Nothing derived depends on data, so heatmaps
+       are rebuilt as soon as labels and their hulls are done, while data may still be syncing."""
+    label_tasks = []
 
-    pool = ThreadPool(4)
-    results = pool.map(normalize, os.listdir(path))
-    pool.close()
-    pool.join()
-    progress.close()
+    def process_label(file_path):
+        label_tasks.append(queue.put(label_convex_hull, file_path))
 
+    with ProcessingQueue(PROCESS_WORKERS) as queue, ThreadPoolExecutor(1) as executor:
+        print("+ Syncing data, normalizing rotation of fetched files")
+        data = executor.submit(download, OWN_DIR_DATA, DATA_DIR, lambda file_path: queue.put(normalize_file, file_path))
 
-def download_data():
-    print("+ Performing data check")
-    if dir_exists(DATA_DIR) is False:
-        print(" * There is no data, downloading...")
-        download(OWN_DIR_DATA, DATA_DIR)
-        normalize_rotation(DATA_DIR)
-    else:
-        print("+ Data exists...")
+        print("+ Syncing labels, generating convex hulls of fetched labels")
+        download(OWN_DIR_LABELS, LABELS_DIR, None if WRITE_CONVEX_HULLS else process_label)
+        for task in label_tasks:
+            task.wait()
+        hulls = dict(task.get() for task in label_tasks if task.successful() and task.get()[1] is not None)
+        build_derived(hulls)
 
-    time.sleep(0.1)
-    print("+ Performing label check")
-    if dir_exists(LABELS_DIR) is False:
-        print("* There is no label data, downloading...")
-        download(OWN_DIR_LABELS, LABELS_DIR)
-    else:
-        print("+ Labels exists...")
+        data.result()
+        queue.wait()
 
-    time.sleep(0.1)
-    print("+ Performing convex hull check")
-    if dir_exists(CONVEX_DIR) is False:
-        print("* There is no convex data, generating...")
-        generate_convex_hull()
-    else:
-        print("+ CONVEX exists...")
+    for arguments, error in queue.failures:
+        print(f"* Failed to process {arguments[0]}: {error}")
 
-    time.sleep(0.1)
-    print("+ Performing heatmap check")
-    if dir_exists(HEATMAP_DIR) is False:
-        print("* There is no heatmap data, generating...")
-        generate_heatmap()
-    else:
-        print("+ Heatmap exists...")
 
+def train_detector(preview=False):
+    with Catalog(CATALOG_FILE) as catalog:
+        valid_set = data_vs_labels_validation(catalog)
+        catalog.update(HEATMAP_DIR, "heatmap", "*_heatmap.png")
+        images = dict((entry.hash, entry.path) for entry in catalog.files("image", root=DATA_DIR))
+        heatmaps = dict((entry.hash, entry.path) for entry in catalog.files("heatmap", root=HEATMAP_DIR))
 
-def main():
-    download_data()
-    # print(len(data_vs_labels_validation()))
-    data = [DATA_DIR + '/' + f + '.jpg' for f in data_vs_labels_validation()]
-    labels = [HEATMAP_DIR + '/' + f for f in os.listdir(HEATMAP_DIR)]
+    hashes = sorted(hash for hash in valid_set if hash in heatmaps)
+    data = [images[hash] for hash in hashes]
+    labels = [heatmaps[hash] for hash in hashes]
 
-    net = DetectorNet(data, labels)
+    net = DetectorNet(data, labels, preload=False, preview=preview)
     net.train()
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Sync training data, rebuild heatmaps and train detector")
+    parser.add_argument("-s", "--stages", nargs="+", choices=STAGES, default=STAGES,
+                        help=f"(default {' '.join(STAGES)})")
+    parser.add_argument("--preview", action="store_true",
+                        help="plot first image with its heatmap before training, saved to file without display")
+    args = parser.parse_args()
+
+    if "download" in args.stages:
+        download_data()
+    if "train" in args.stages:
+        train_detector(args.preview)
+
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,16 @@
 # -*- encoding: utf-8 -*-
 import argparse
-import fnmatch
 import os
 import pathlib
 
-import cv2
 import numpy as np
 from PIL import Image
 
+from utils.catalog import CATALOG_FILE, Catalog
+from utils.lazy import lazy_import
+
+cv2 = lazy_import("cv2")
+
 
 def _debug_resize(img):
     height, width = img.shape[:2]
@@ -30,12 +33,6 @@ def _debug_draw_image_and_wait(name, img):
     cv2.waitKey(0)
 
 
-def files_recursively(dir_path, pattern="*.png"):
-    for path, dir_name, file_names in os.walk(dir_path):
-        for file_name in fnmatch.filter(file_names, pattern):
-            yield os.path.join(path, file_name)
-
-
 def p2abs(point):
     return np.math.sqrt(point[0] ** 2 + point[1] ** 2)
 
@@ -83,19 +80,24 @@ def rotate_with_bounding_rect(img, bounding_rect, img_size):
     return img
 
 
-def generate_thumbnails(dir, images, heatmaps, out_dir=None):
+def generate_thumbnails(dir, images, heatmaps, out_dir=None, catalog_path=CATALOG_FILE):
     global hashed_images_map
-    hashed_images_map = {image.split('/')[-1].split('.')[0]: image for image in files_recursively(images, "*.jpg")}
-    hashed_heatmap_map = {image.split('/')[-1].split('_heatmap')[0]: image for image in
-                          files_recursively(heatmaps, "*.png")}
-
-    for file in files_recursively(dir):
+    with Catalog(catalog_path) as catalog:
+        catalog.update(images, "image", "*.jpg")
+        catalog.update(heatmaps, "heatmap", "*.png")
+        catalog.update(dir, "label", "*.png")
+        hashed_images_map = {entry.hash: entry.path for entry in catalog.files("image", root=images)}
+        hashed_heatmap_map = {entry.hash: entry.path for entry in catalog.files("heatmap", root=heatmaps)}
+        labels = catalog.files("label", root=dir)
+
+    for entry in labels:
+        file = entry.path
         label_img = cv2.imread(file)
 
         if label_img is None:
             continue
 
-        hash = file.split('/')[-1].split('_')[0]
+        hash = entry.hash
 
         # normalize rotation according to heatmap min area rect
         heatmap = Image.open(hashed_heatmap_map[hash]).convert('L')
@@ -149,10 +151,11 @@ def main():
     parser.add_argument("images", help="Hashed images directory", type=str)
     parser.add_argument("heatmaps", help="Hashed heatmap directory", type=str)
     parser.add_argument("--debug", help="Enable debug", action="store_true")
+    parser.add_argument("--catalog", help=f"(default {CATALOG_FILE})", type=str, default=CATALOG_FILE)
     args = parser.parse_args()
     global is_debug
     is_debug = args.debug
-    generate_thumbnails(args.labels, args.images, args.heatmaps, "out")
+    generate_thumbnails(args.labels, args.images, args.heatmaps, "out", args.catalog)
 
 
 if __name__ == '__main__':
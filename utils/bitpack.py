@@ -0,0 +1,153 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from utils.image import apply_rotation
+
+MAGIC = b"BWPACK1\n"
+ALIGNMENT = 64
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class BitPackWriter:
+    """Stores many binary images of the same size in single file, one np.packbits layer per variant.
+       Layout: magic, header length, json header (size, orientation, variants), aligned layers."""
+
+    def __init__(self, path, width, height, variants, orientation=1):
+        self.row_bytes = (width + 7) // 8
+        header = {
+            "width": width,
+            "height": height,
+            "orientation": orientation,
+            "variants": variants,
+        }
+        header = json.dumps(header).encode()
+        data_offset = len(MAGIC) + 8 + len(header)
+        data_offset += -data_offset % ALIGNMENT
+        header += b" " * (data_offset - len(MAGIC) - 8 - len(header))
+
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.truncate(data_offset + len(variants) * height * self.row_bytes)
+
+        self.layers = np.memmap(path, dtype=np.uint8, mode="r+", offset=data_offset,
+                                shape=(len(variants), height, self.row_bytes))
+
+    def write(self, index, packed, start=0):
+        """Stores packed rows of variant index from row start on."""
+        self.layers[index, start:start + len(packed)] = packed
+
+    def close(self):
+        if self.layers is not None:
+            self.layers.flush()
+            self.layers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BitPackReader:
+    """Reads single variant out of BitPackWriter file, layers are memory mapped so
+       only requested one is ever read from disk."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError(f"{path} is not bit packed container")
+            header_length, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length).decode())
+
+        self.width = header["width"]
+        self.height = header["height"]
+        self.orientation = header["orientation"]
+        self.variants = header["variants"]
+        self.layers = np.memmap(path, dtype=np.uint8, mode="r", offset=len(MAGIC) + 8 + header_length,
+                                shape=(len(self.variants), self.height, (self.width + 7) // 8))
+
+    def index(self, key):
+        """Accepts layer index or variant suffix."""
+        if isinstance(key, int):
+            return key
+        for index, variant in enumerate(self.variants):
+            if variant["suffix"] == key:
+                return index
+        raise KeyError(key)
+
+    def packed(self, key):
+        """Memory mapped packed rows as stored, without rotation."""
+        return self.layers[self.index(key)]
+
+    def binary(self, key):
+        return np.unpackbits(self.packed(key), axis=1)[:, :self.width].astype(bool)
+
+    def image(self, key):
+        image = Image.frombytes('1', (self.width, self.height), np.ascontiguousarray(self.packed(key)).tobytes())
+        return apply_rotation(self.orientation, image)
+
+    def close(self):
+        self.layers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+class BilevelPngWriter:
+    """Writes 1-bit png from np.packbits rows while they come, strip by strip, so whole image
+       is never held in memory. File is removed when it's left before all rows were written."""
+
+    def __init__(self, path, width, height):
+        self.path = path
+        self.height = height
+        self.rows = 0
+        self.compressor = zlib.compressobj()
+        self.file = open(path, "wb")
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 0, 0, 0, 0)))
+
+    def write(self, packed):
+        # every png row starts with filter type, 0 leaves row as it is
+        rows = np.zeros((packed.shape[0], packed.shape[1] + 1), dtype=np.uint8)
+        rows[:, 1:] = packed
+        self.rows += len(packed)
+        data = self.compressor.compress(rows.tobytes())
+        if len(data) > 0:
+            self.file.write(_png_chunk(b"IDAT", data))
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.rows != self.height:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
+            raise IOError(f"{self.path} got {self.rows} of {self.height} rows")
+        self.file.write(_png_chunk(b"IDAT", self.compressor.flush()))
+        self.file.write(_png_chunk(b"IEND", b""))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path)
+        self.close()
@@ -0,0 +1,139 @@
+import json
+import os
+from collections import namedtuple
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+Rule = namedtuple("Rule", ["outputs", "inputs", "function", "arguments"])
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _run_rule(task):
+    index, rule = task
+    try:
+        rule.function(*rule.arguments)
+    except Exception as error:
+        return index, error
+    missing = [output for output in rule.outputs if not os.path.exists(output)]
+    return index, (None, IOError(f"{missing} weren't created"))[len(missing) > 0]
+
+
+class BuildGraph:
+    """Make-like graph, every rule builds its output files from input files with function(*arguments).
+       Rule is stale when any output is missing, older than any input, was built from different
+       inputs last time (they are recorded in state_path) or when rule producing its input is stale.
+       Rules which don't depend on each other run together in process pool."""
+
+    def __init__(self, state_path=None):
+        self.state_path = state_path
+        self.rules = []
+        self.producers = {}
+
+    def add(self, outputs, inputs, function, *arguments):
+        rule = Rule(list(outputs), sorted(inputs), function, arguments)
+        for output in rule.outputs:
+            if output in self.producers:
+                raise ValueError(f"{output} is produced by more than one rule")
+            self.producers[output] = len(self.rules)
+        self.rules.append(rule)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (TypeError, IOError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        if self.state_path is not None:
+            temp_path = f"{self.state_path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+            os.replace(temp_path, self.state_path)
+
+    def levels(self):
+        """Rule indices grouped so that rules of one level depend only on rules of lower levels."""
+        depths = {}
+
+        def depth(index, visiting=()):
+            if index not in depths:
+                if index in visiting:
+                    raise ValueError(f"Rule producing {self.rules[index].outputs} depends on itself")
+                dependencies = [self.producers[path] for path in self.rules[index].inputs if path in self.producers]
+                depths[index] = 1 + max((depth(dependency, visiting + (index,)) for dependency in dependencies),
+                                        default=-1)
+            return depths[index]
+
+        levels = []
+        for index in range(len(self.rules)):
+            level = depth(index)
+            levels.extend([] for _ in range(level + 1 - len(levels)))
+            levels[level].append(index)
+        return levels
+
+    def is_stale(self, rule, state, stale_outputs):
+        if any(path in stale_outputs for path in rule.inputs):
+            return True
+        output_times = [_mtime(output) for output in rule.outputs]
+        if None in output_times:
+            return True
+        if self.state_path is not None and any(state.get(output) != rule.inputs for output in rule.outputs):
+            return True
+        input_times = [_mtime(path) for path in rule.inputs]
+        return max((time for time in input_times if time is not None), default=0) > min(output_times)
+
+    def stale_levels(self, state):
+        stale_outputs = set()
+        levels = []
+        for level in self.levels():
+            stale = [index for index in level if self.is_stale(self.rules[index], state, stale_outputs)]
+            for index in stale:
+                stale_outputs.update(self.rules[index].outputs)
+            levels.append(stale)
+        return levels
+
+    def build(self, jobs=None):
+        """Rebuilds stale outputs only, rules depending on failed ones are skipped.
+           Returns (number of rules built, list of (outputs, error))."""
+        state = self.load_state()
+        levels = self.stale_levels(state)
+        progress = tqdm(range(sum(len(level) for level in levels)), unit="file")
+        failed_outputs = set()
+        failures = []
+        built = 0
+
+        pool = Pool(jobs)
+        try:
+            for level in levels:
+                tasks = []
+                for index in level:
+                    rule = self.rules[index]
+                    if any(path in failed_outputs for path in rule.inputs):
+                        failed_outputs.update(rule.outputs)
+                        progress.update()
+                    else:
+                        tasks.append((index, rule))
+
+                for index, error in pool.imap_unordered(_run_rule, tasks):
+                    rule = self.rules[index]
+                    if error is None:
+                        state.update((output, rule.inputs) for output in rule.outputs)
+                        built += 1
+                    else:
+                        failed_outputs.update(rule.outputs)
+                        failures.append((rule.outputs, error))
+                    progress.update()
+        finally:
+            pool.close()
+            pool.join()
+            progress.close()
+            self.save_state(state)
+
+        return built, failures
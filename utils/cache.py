@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import shutil
+from contextlib import suppress
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """Key from json serializable parts, e.g. source digest and parameters."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    """Content addressed store of result files, one file per key.
+       Hits refresh file mtime, evict removes least recently used entries until
+       cache fits into max_bytes. Safe to share between processes."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, file_path):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(str(file_path), temp_path)
+        os.replace(temp_path, path)
+
+    def restore(self, key, target_path):
+        """Copies cached result to target_path if it's missing or differs in size.
+           Returns False on cache miss."""
+        path = self.get(key)
+        if path is None:
+            return False
+        target_path = str(target_path)
+        if not os.path.exists(target_path) or os.path.getsize(target_path) != os.path.getsize(path):
+            with suppress(FileNotFoundError):
+                shutil.copyfile(path, target_path)
+                return True
+            return False
+        return True
+
+    def evict(self):
+        entries = []
+        for path, dir_names, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                with suppress(FileNotFoundError):
+                    stat = os.stat(os.path.join(path, file_name))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(path, file_name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
@@ -0,0 +1,229 @@
+import fnmatch
+import os
+import sqlite3
+from collections import namedtuple
+from multiprocessing import Pool
+
+from PIL import Image
+
+from utils.lazy import lazy_import
+
+# pulls in scipy, only needed when new images are hashed
+imagehash = lazy_import("imagehash")
+
+CATALOG_FILE = "catalog.sqlite"
+KINDS = ("image", "label", "hull", "heatmap")
+
+# the same file can be indexed as different kinds, directory is scanned separately for every
+# kind, pattern and recursive, scan manages only files whose names match its pattern
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    root TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    phash TEXT,
+    PRIMARY KEY (path, kind)
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash, kind);
+CREATE INDEX IF NOT EXISTS files_root ON files (root, kind);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory, kind);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    recursive INTEGER NOT NULL,
+    parent TEXT,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (path, kind, pattern, recursive)
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent, kind, pattern, recursive);
+"""
+
+Entry = namedtuple("Entry", ["path", "hash", "kind", "size", "mtime", "phash"])
+
+
+def file_hash(file_name, kind):
+    """Images are named <hash>.<extension>, labels, hulls and heatmaps <hash>_<suffix>.png."""
+    if kind == "image":
+        return file_name.split('.')[0]
+    return file_name.split('_')[0]
+
+
+def _phash(path):
+    try:
+        with Image.open(path) as image:
+            return path, str(imagehash.phash(image))
+    except IOError:
+        # empty string marks files which aren't images, so they aren't retried
+        return path, ""
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class Catalog:
+    """SQLite index of dataset files by image hash with their size, mtime and perceptual hash.
+       update lists only directories whose mtime changed since the last update with the same kind,
+       pattern and recursive, so files rewritten in place are picked up only by update with force.
+       Phash is computed only for new and changed images."""
+
+    def __init__(self, path=CATALOG_FILE):
+        self.connection = sqlite3.connect(path)
+        self.connection.create_function("fnmatch", 2, fnmatch.fnmatch)
+        self.connection.executescript(SCHEMA)
+
+    def _forget_directory(self, path, kind, pattern, recursive):
+        like = _escape_like(path) + "/%"
+        removed = self.connection.execute(
+            "DELETE FROM files WHERE (directory = ? OR directory LIKE ? ESCAPE '\\') AND kind = ? AND fnmatch(name, ?)",
+            (path, like, kind, pattern)).rowcount
+        self.connection.execute(
+            "DELETE FROM directories WHERE (path = ? OR path LIKE ? ESCAPE '\\') AND kind = ? AND pattern = ? "
+            "AND recursive = ?", (path, like, kind, pattern, recursive))
+        return removed
+
+    def _scan(self, path, root, kind, pattern, recursive, pending):
+        """Compares one directory listing with the index, returns (changed, removed) counts."""
+        known = dict((row[0], (row[1], row[2])) for row in self.connection.execute(
+            "SELECT path, size, mtime FROM files WHERE directory = ? AND kind = ? AND fnmatch(name, ?)",
+            (path, kind, pattern)))
+        subdirectories = set(row[0] for row in self.connection.execute(
+            "SELECT path FROM directories WHERE parent = ? AND kind = ? AND pattern = ? AND recursive = ?",
+            (path, kind, pattern, recursive)))
+        changed = 0
+
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        pending.append((entry.path, path))
+                        subdirectories.discard(entry.path)
+                    continue
+                if not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                stat = entry.stat()
+                if known.pop(entry.path, None) != (stat.st_size, stat.st_mtime):
+                    self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                                            (entry.path, entry.name, path, root, kind, file_hash(entry.name, kind),
+                                             stat.st_size, stat.st_mtime))
+                    changed += 1
+
+        removed = len(known)
+        self.connection.executemany("DELETE FROM files WHERE path = ? AND kind = ?",
+                                    [(file_path, kind) for file_path in known])
+        for subdirectory in subdirectories:
+            removed += self._forget_directory(subdirectory, kind, pattern, recursive)
+        return changed, removed
+
+    def update(self, directory, kind, pattern="*", recursive=True, phash=None, force=False, jobs=None):
+        """Indexes files matching pattern under directory as kind, phash is computed for images
+           by default. Returns (number of new or changed files, number of removed files)."""
+        if kind not in KINDS:
+            raise ValueError(f"Unknown kind {kind}, expected one of {KINDS}")
+        root = os.path.normpath(directory)
+        recursive = int(recursive)
+        phash = kind == "image" if phash is None else phash
+        changed, removed = 0, 0
+        pending = [(root, None)]
+
+        with self.connection:
+            while len(pending) > 0:
+                path, parent = pending.pop()
+                try:
+                    mtime = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    removed += self._forget_directory(path, kind, pattern, recursive)
+                    continue
+
+                scan = (path, kind, pattern, recursive)
+                row = self.connection.execute(
+                    "SELECT mtime FROM directories WHERE path = ? AND kind = ? AND pattern = ? AND recursive = ?",
+                    scan).fetchone()
+                if not force and row is not None and row[0] == mtime:
+                    # same entries as last time, only subdirectories can differ
+                    if recursive:
+                        pending.extend((row[0], path) for row in self.connection.execute(
+                            "SELECT path FROM directories WHERE parent = ? AND kind = ? AND pattern = ? "
+                            "AND recursive = ?", scan))
+                    continue
+
+                directory_changed, directory_removed = self._scan(path, root, kind, pattern, recursive, pending)
+                changed += directory_changed
+                removed += directory_removed
+                self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?)",
+                                        scan + (parent, mtime))
+
+            if phash:
+                paths = [row[0] for row in self.connection.execute(
+                    "SELECT path FROM files WHERE root = ? AND kind = ? AND phash IS NULL", (root, kind))]
+                if len(paths) > 0:
+                    pool = Pool(jobs)
+                    hashes = pool.map(_phash, paths, chunksize=16)
+                    pool.close()
+                    pool.join()
+                    self.connection.executemany("UPDATE files SET phash = ? WHERE path = ? AND kind = ?",
+                                                [(value, path, kind) for path, value in hashes])
+
+        return changed, removed
+
+    def _entries(self, conditions, parameters):
+        where = " AND ".join(conditions) if len(conditions) > 0 else "1"
+        rows = self.connection.execute(
+            f"SELECT path, hash, kind, size, mtime, phash FROM files WHERE {where} ORDER BY path", parameters)
+        return [Entry(*row) for row in rows]
+
+    def files(self, kind=None, hash=None, root=None):
+        conditions, parameters = [], []
+        for column, value in (("kind", kind), ("hash", hash), ("root", root)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(os.path.normpath(value) if column == "root" else value)
+        return self._entries(conditions, parameters)
+
+    def find(self, kind, text, root=None):
+        """Files of kind whose name contains text, case sensitive like glob."""
+        conditions, parameters = ["kind = ?", "instr(name, ?) > 0"], [kind, text]
+        if root is not None:
+            conditions.append("root = ?")
+            parameters.append(os.path.normpath(root))
+        return self._entries(conditions, parameters)
+
+    def hashes(self, kind, root=None):
+        return set(entry.hash for entry in self.files(kind, root=root))
+
+    def add(self, path, kind, root, phash=None):
+        """Records single file written by caller, without waiting for update."""
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (path, name, os.path.dirname(path), os.path.normpath(root), kind,
+                                     file_hash(name, kind), stat.st_size, stat.st_mtime, phash))
+
+    def remove(self, path):
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (os.path.normpath(path),))
+
+    def move(self, old_path, new_path):
+        """Records renamed file under every kind it's indexed as, its phash is kept."""
+        rows = self.connection.execute("SELECT root, kind, phash FROM files WHERE path = ?",
+                                       (os.path.normpath(old_path),)).fetchall()
+        self.remove(old_path)
+        for root, kind, phash in rows:
+            self.add(new_path, kind, root, phash)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
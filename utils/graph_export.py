@@ -0,0 +1,220 @@
+import time
+
+import numpy as np
+
+from utils.lazy import lazy_import
+
+tf = lazy_import("tensorflow")
+graph_io = lazy_import("tensorflow.python.framework.graph_io")
+graph_util = lazy_import("tensorflow.python.framework.graph_util")
+graph_transforms = lazy_import("tensorflow.tools.graph_transforms")
+
+# constants have to be folded before batch norm can be merged into convolution weights
+PREPARE_TRANSFORMS = [
+    "strip_unused_nodes",
+    "remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)",
+    "fold_constants(ignore_errors=true)",
+]
+TRANSFORMS = [
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "merge_duplicate_nodes",
+    "strip_unused_nodes",
+    "sort_by_execution_order",
+]
+QUANTIZATIONS = ("float16", "int8")
+# fold_old_batch_norms of TF 1.x knows neither FusedBatchNormV3 of Keras nor bias between convolution and batch norm
+BATCH_NORMS = ("FusedBatchNorm", "FusedBatchNormV2", "FusedBatchNormV3")
+CONVOLUTIONS = ("Conv2D", "DepthwiseConv2dNative")
+# shapes, scalars and biases aren't worth the extra op
+MIN_QUANTIZED_ELEMENTS = 1024
+LATENCY_RUNS = 20
+DEFAULT_DIMENSION = 256
+
+
+def float16_weights(graph_def, min_elements=MIN_QUANTIZED_ELEMENTS):
+    """Stores large float32 constants as float16 followed by Cast back to float32 under the original
+       name, so weights take half of the space and nodes using them stay untouched."""
+    optimized = tf.GraphDef()
+    optimized.versions.CopyFrom(graph_def.versions)
+    optimized.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op != "Const" or node.attr["dtype"].type != tf.float32.as_datatype_enum:
+            optimized.node.extend([node])
+            continue
+        weights = tf.make_ndarray(node.attr["value"].tensor)
+        if weights.size < min_elements:
+            optimized.node.extend([node])
+            continue
+
+        half = optimized.node.add()
+        half.op = "Const"
+        half.name = node.name + "/float16"
+        half.device = node.device
+        half.attr["dtype"].type = tf.float16.as_datatype_enum
+        half.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(weights.astype(np.float16)))
+
+        cast = optimized.node.add()
+        cast.op = "Cast"
+        cast.name = node.name
+        cast.device = node.device
+        cast.input.append(half.name)
+        cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+        cast.attr["DstT"].type = tf.float32.as_datatype_enum
+    return optimized
+
+
+def _node_name(input_name):
+    return input_name.lstrip("^").split(":")[0]
+
+
+def _constant_node(graph_def, name, value, device):
+    node = graph_def.node.add()
+    node.op = "Const"
+    node.name = name
+    node.device = device
+    node.attr["dtype"].type = tf.float32.as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float32)))
+
+
+def fold_batch_norms(graph_def):
+    """Inference batch norms following convolution, with or without bias in between, folded into
+       convolution weights and bias. Batch norm node is replaced by BiasAdd of the same name on top
+       of new convolution, nodes it replaces are left for strip_unused_nodes."""
+    nodes = dict((node.name, node) for node in graph_def.node)
+    # other outputs of batch norm are only for training
+    used_outputs = set(input_name.lstrip("^") for node in graph_def.node for input_name in node.input)
+
+    def constant(input_name):
+        node = nodes.get(_node_name(input_name))
+        return tf.make_ndarray(node.attr["value"].tensor) if node is not None and node.op == "Const" else None
+
+    def foldable(node):
+        if node.op not in BATCH_NORMS or node.attr["is_training"].b:
+            return None
+        if any(f"{node.name}:{index}" in used_outputs for index in range(1, 6)):
+            return None
+        parameters = [constant(name) for name in node.input[1:5]]
+        bias, convolution = None, nodes.get(_node_name(node.input[0]))
+        if convolution is not None and convolution.op == "BiasAdd":
+            bias, convolution = constant(convolution.input[1]), nodes.get(_node_name(convolution.input[0]))
+            if bias is None:
+                return None
+        if convolution is None or convolution.op not in CONVOLUTIONS:
+            return None
+        weights = constant(convolution.input[1])
+        if weights is None or any(parameter is None for parameter in parameters):
+            return None
+        return convolution, weights, bias, parameters
+
+    folded = tf.GraphDef()
+    folded.versions.CopyFrom(graph_def.versions)
+    folded.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        found = foldable(node)
+        if found is None:
+            folded.node.extend([node])
+            continue
+        convolution, weights, bias, (scale, offset, mean, variance) = found
+        factor = scale / np.sqrt(variance + node.attr["epsilon"].f)
+        bias = offset + ((0 if bias is None else bias) - mean) * factor
+        # weights are HWIO for Conv2D and HW(I, multiplier) for depthwise, outputs are the last axes either way
+        output_shape = weights.shape[(2, 3)[convolution.op == "Conv2D"]:]
+        _constant_node(folded, node.name + "/folded_weights", weights * factor.reshape(output_shape), node.device)
+        _constant_node(folded, node.name + "/folded_bias", bias, node.device)
+
+        new_convolution = folded.node.add()
+        new_convolution.CopyFrom(convolution)
+        new_convolution.name = node.name + "/folded_convolution"
+        new_convolution.input[1] = node.name + "/folded_weights"
+
+        bias_add = folded.node.add()
+        bias_add.op = "BiasAdd"
+        bias_add.name = node.name
+        bias_add.device = node.device
+        bias_add.input.extend([new_convolution.name, node.name + "/folded_bias"])
+        bias_add.attr["T"].type = tf.float32.as_datatype_enum
+        bias_add.attr["data_format"].CopyFrom(node.attr["data_format"])
+    return folded
+
+
+def optimize_graph(graph_def, input_names, output_names, quantize=None):
+    """Frozen graph reduced to what outputs need for inference: training and unused nodes are stripped,
+       constants and batch norms folded and weights optionally quantized to float16 or int8."""
+    if quantize is not None and quantize not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantize}, expected one of {QUANTIZATIONS}")
+    transforms = list(TRANSFORMS)
+    if quantize == "int8":
+        # after folding, otherwise dequantize would be folded back into float constants
+        transforms.insert(-1, f"quantize_weights(minimum_size={MIN_QUANTIZED_ELEMENTS})")
+    optimized = graph_transforms.TransformGraph(graph_def, input_names, output_names, PREPARE_TRANSFORMS)
+    optimized = fold_batch_norms(optimized)
+    optimized = graph_transforms.TransformGraph(optimized, input_names, output_names, transforms)
+    return float16_weights(optimized) if quantize == "float16" else optimized
+
+
+def sample_inputs(graph_def, input_names, input_shapes=None, seed=0):
+    """Random array for every input placeholder, unknown batch size is 1 and other unknown dimensions
+       DEFAULT_DIMENSION unless shape is given in input_shapes (name -> shape)."""
+    nodes = dict((node.name, node) for node in graph_def.node)
+    rng = np.random.RandomState(seed)
+    inputs = {}
+    for name in input_names:
+        attributes = nodes[name].attr
+        shape = (input_shapes or {}).get(name)
+        if shape is None:
+            sizes = [dimension.size for dimension in attributes["shape"].shape.dim]
+            shape = [(size, (1, DEFAULT_DIMENSION)[index > 0])[size < 0] for index, size in enumerate(sizes)]
+        inputs[name] = rng.uniform(size=shape).astype(tf.as_dtype(attributes["dtype"].type).as_numpy_dtype)
+    return inputs
+
+
+def run_graph(graph_def, inputs, output_names, runs=LATENCY_RUNS):
+    """Runs graph on CPU with inputs (name -> array). Returns outputs and the best and median latency
+       in seconds of runs after warm up run."""
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    feeds = dict((graph.get_tensor_by_name(name + ":0"), value) for name, value in inputs.items())
+    fetches = [graph.get_tensor_by_name(name + ":0") for name in output_names]
+
+    with tf.Session(graph=graph, config=tf.ConfigProto(device_count={"GPU": 0})) as session:
+        outputs = session.run(fetches, feeds)
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            session.run(fetches, feeds)
+            times.append(time.perf_counter() - start)
+    return outputs, min(times), float(np.median(times))
+
+
+def compare(frozen, optimized, input_names, output_names, runs=LATENCY_RUNS, input_shapes=None):
+    """Prints size, CPU latency and the largest output difference of frozen and optimized graph."""
+    report = {"size": (frozen.ByteSize(), optimized.ByteSize())}
+    print(f"Size: {report['size'][0] / 2 ** 20:.2f}MB -> {report['size'][1] / 2 ** 20:.2f}MB "
+          f"(x{report['size'][1] / report['size'][0]:.2f})")
+    if runs <= 0:
+        return report
+
+    inputs = sample_inputs(frozen, input_names, input_shapes)
+    before, before_best, before_median = run_graph(frozen, inputs, output_names, runs)
+    after, after_best, after_median = run_graph(optimized, inputs, output_names, runs)
+    report["latency"] = (before_median, after_median)
+    report["difference"] = max(float(np.max(np.abs(old - new))) for old, new in zip(before, after))
+    print(f"CPU latency: median {before_median * 1000:.1f}ms best {before_best * 1000:.1f}ms -> "
+          f"median {after_median * 1000:.1f}ms best {after_best * 1000:.1f}ms "
+          f"(x{after_median / before_median:.2f})")
+    print(f"Largest output difference: {report['difference']:.6f}")
+    return report
+
+
+def export(session, input_names, output_names, directory, file_name, optimize=True, quantize=None,
+           runs=LATENCY_RUNS):
+    """Freezes session graph, optimizes it for inference unless optimize is False and writes it as binary pb."""
+    graph_def = graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+    if optimize:
+        optimized = optimize_graph(graph_def, input_names, output_names, quantize)
+        compare(graph_def, optimized, input_names, output_names, runs)
+        graph_def = optimized
+    graph_io.write_graph(graph_def, directory, file_name, as_text=False)
+    return graph_def
@@ -1,17 +1,137 @@
+import os
+import shutil
+import struct
+import subprocess
+
+import numpy as np
 from PIL import Image
+from PIL import JpegImagePlugin
 
+ORIENTATION = 0x0112
+ROTATIONS = {
+    3: Image.ROTATE_180,
+    6: Image.ROTATE_270,
+    8: Image.ROTATE_90
+}
+# every EXIF orientation including mirrored ones, as PIL transpose and as jpegtran arguments
+TRANSPOSITIONS = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90
+}
+JPEGTRAN_TRANSFORMS = {
+    2: ["-flip", "horizontal"],
+    3: ["-rotate", "180"],
+    4: ["-flip", "vertical"],
+    5: ["-transpose"],
+    6: ["-rotate", "90"],
+    7: ["-transverse"],
+    8: ["-rotate", "270"]
+}
+JPEGTRAN = shutil.which("jpegtran")
+# APP1 (exif, xmp), APP13 (iptc) and comment, color profile and JFIF/Adobe markers are kept
+JPEG_METADATA_MARKERS = (0xE1, 0xED, 0xFE)
+JPEG_START_OF_SCAN = 0xDA
 
-def apply_rotation_from_original(original, target):
+
+def exif_orientation(original):
     if hasattr(original, '_getexif'):
-        orientation = 0x0112
         exif = original._getexif()
-        if exif is not None and orientation in exif:
-            orientation = exif[orientation]
-            rotations = {
-                3: Image.ROTATE_180,
-                6: Image.ROTATE_270,
-                8: Image.ROTATE_90
-            }
-            if orientation in rotations:
-                return target.transpose(rotations[orientation])
-    return target
\ No newline at end of file
+        if exif is not None and ORIENTATION in exif:
+            return exif[ORIENTATION]
+    return 1
+
+
+def apply_rotation(orientation, target):
+    if orientation in ROTATIONS:
+        return target.transpose(ROTATIONS[orientation])
+    return target
+
+
+def apply_rotation_from_original(original, target):
+    return apply_rotation(exif_orientation(original), target)
+
+
+def strip_jpeg_metadata(data):
+    """Drops metadata segments from JPEG header, compressed image data is copied as is."""
+    if data[:2] != b"\xff\xd8":
+        raise IOError("Not a JPEG file")
+    parts = [data[:2]]
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            raise IOError("Corrupted JPEG marker")
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker == JPEG_START_OF_SCAN:
+            break
+        end = position + 2 + struct.unpack(">H", data[position + 2:position + 4])[0]
+        if marker not in JPEG_METADATA_MARKERS:
+            parts.append(data[position:end])
+        position = end
+    parts.append(data[position:])
+    return b"".join(parts)
+
+
+def _jpegtran(path, orientation):
+    """Lossless transform, fails with -perfect when image isn't made of whole MCU blocks."""
+    if JPEGTRAN is None or orientation not in JPEGTRAN_TRANSFORMS:
+        return False
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    result = subprocess.run([JPEGTRAN, "-copy", "none", "-perfect"] + JPEGTRAN_TRANSFORMS[orientation]
+                            + ["-outfile", temp_path, path], stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, path)
+    return True
+
+
+def normalize_orientation(path):
+    """Applies EXIF orientation to pixels and drops metadata, file is replaced only when needed.
+       Upright JPEG only loses its metadata segments without decoding, rotated one is transformed
+       losslessly by jpegtran if it's installed and image allows, otherwise it's re-encoded
+       with its own quantization tables. Returns True when file was rewritten."""
+    with Image.open(path) as image:
+        orientation = exif_orientation(image)
+        has_metadata = "exif" in image.info or "comment" in image.info
+        if orientation == 1 and not has_metadata:
+            return False
+
+        if image.format == "JPEG":
+            if orientation == 1:
+                with open(path, "rb") as f:
+                    data = strip_jpeg_metadata(f.read())
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                return True
+            if _jpegtran(path, orientation):
+                return True
+
+        options = {}
+        if image.format == "JPEG":
+            options = {"qtables": image.quantization, "subsampling": JpegImagePlugin.get_sampling(image)}
+        normalized = image.transpose(TRANSPOSITIONS[orientation]) if orientation in TRANSPOSITIONS else image
+        # save doesn't carry exif over unless it's passed explicitly
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        normalized.save(temp_path, format=image.format, **options)
+    os.replace(temp_path, path)
+    return True
+
+
+def load_mask(path):
+    with Image.open(path) as image:
+        return np.array(image.convert('L')) != 0
+
+
+def save_mask(path, mask):
+    Image.fromarray(np.uint8(mask) * 255).save(path)
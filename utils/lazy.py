@@ -0,0 +1,29 @@
+import importlib
+
+
+class LazyModule:
+    """Stands in for module until its first attribute is used, then imports it.
+       Keeps TensorFlow, Keras, cv2 and similar out of startup of commands which never use them."""
+
+    def __init__(self, name):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        if self._module is None:
+            object.__setattr__(self, "_module", importlib.import_module(self._name))
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        state = "not loaded" if self._module is None else "loaded"
+        return f"<lazy module {self._name}, {state}>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,53 @@
+import os
+import threading
+from multiprocessing import Pool
+
+
+class ProcessingQueue:
+    """Runs function(*args) in process pool for tasks put from any thread while they are produced.
+       At most max_pending tasks wait or run at once and put blocks above that, so producer
+       (e.g. download workers) slows down to processing speed instead of piling up work."""
+
+    def __init__(self, workers=None, max_pending=None):
+        workers = workers or os.cpu_count()
+        self.pool = Pool(workers)
+        self.max_pending = max_pending or 2 * workers
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.results = []
+        self.failures = []
+
+    def put(self, function, *args):
+        """Returns AsyncResult of the task, to wait only for some of the tasks."""
+        self.slots.acquire()
+
+        def done(result):
+            with self.lock:
+                self.results.append(result)
+            self.slots.release()
+
+        def failed(error):
+            with self.lock:
+                self.failures.append((args, error))
+            self.slots.release()
+
+        return self.pool.apply_async(function, args, callback=done, error_callback=failed)
+
+    def wait(self):
+        """Blocks until every task put so far is finished."""
+        for _ in range(self.max_pending):
+            self.slots.acquire()
+        for _ in range(self.max_pending):
+            self.slots.release()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.pool.terminate()
+        self.close()
@@ -0,0 +1,157 @@
+import struct
+
+import numpy as np
+
+from utils.image import load_mask, save_mask
+
+HEADER = "<IIQc"
+
+
+def _normalize(starts, ends):
+    """Drops empty runs and joins runs touching each other."""
+    keep = starts < ends
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+    separate = starts[1:] != ends[:-1]
+    return np.concatenate([starts[:1], starts[1:][separate]]), np.concatenate([ends[:-1][separate], ends[-1:]])
+
+
+class RunLengthMask:
+    """Binary mask kept as sorted, disjoint [start, end) runs of foreground pixels,
+       positions are indices into row-major flattened mask.
+       Masks are mostly background, so a run per row is all convex hull needs."""
+
+    def __init__(self, shape, starts, ends):
+        self.shape = tuple(shape)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    @classmethod
+    def empty(cls, shape):
+        return cls(shape, [], [])
+
+    @classmethod
+    def from_array(cls, mask):
+        flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+        changes = np.flatnonzero(np.diff(np.concatenate([[False], flat, [False]])))
+        return cls(mask.shape, changes[0::2], changes[1::2])
+
+    @classmethod
+    def from_rows(cls, shape, left, right):
+        """Mask with pixels left[y] .. right[y] (inclusive) set in every row y, rows with left > right are empty."""
+        rows = np.flatnonzero(left <= right)
+        starts = rows * shape[1] + left[rows]
+        ends = rows * shape[1] + right[rows] + 1
+        return cls(shape, *_normalize(starts, ends))
+
+    @classmethod
+    def from_png(cls, path):
+        return cls.from_array(load_mask(path))
+
+    def to_array(self):
+        height, width = self.shape
+        changes = np.zeros(height * width + 1, dtype=np.int8)
+        changes[self.starts] = 1
+        changes[self.ends] -= 1
+        return np.cumsum(changes[:-1], dtype=np.int8).astype(bool).reshape(self.shape)
+
+    def to_png(self, path):
+        save_mask(path, self.to_array())
+
+    @property
+    def area(self):
+        return int(np.sum(self.ends - self.starts))
+
+    def bounding_box(self):
+        """(top, left, bottom, right) inclusive, None for empty mask."""
+        if len(self.starts) == 0:
+            return None
+        rows, starts, ends = self._row_pieces()
+        return int(rows[0]), int(starts.min()), int(rows[-1]), int(ends.max()) - 1
+
+    @classmethod
+    def _combine(cls, masks, union):
+        masks = list(masks)
+        if len(masks) == 0:
+            raise ValueError("At least one mask is required")
+        shape = masks[0].shape
+        if any(mask.shape != shape for mask in masks):
+            raise ValueError(f"Mask shapes differ: {[mask.shape for mask in masks]}")
+
+        positions = np.concatenate([mask.starts for mask in masks] + [mask.ends for mask in masks])
+        count = sum(len(mask.starts) for mask in masks)
+        deltas = np.concatenate([np.ones(count, dtype=np.int64), -np.ones(count, dtype=np.int64)])
+        # on the same position union opens runs before closing them, intersection closes first
+        order = np.lexsort((-deltas if union else deltas, positions))
+        depth = np.cumsum(deltas[order])
+        positions = positions[order]
+
+        inside = depth >= (1 if union else len(masks))
+        before = np.concatenate([[False], inside[:-1]])
+        return cls(shape, *_normalize(positions[inside & ~before], positions[~inside & before]))
+
+    @classmethod
+    def union(cls, *masks):
+        return cls._combine(masks, union=True)
+
+    @classmethod
+    def intersection(cls, *masks):
+        return cls._combine(masks, union=False)
+
+    def __or__(self, other):
+        return RunLengthMask.union(self, other)
+
+    def __and__(self, other):
+        return RunLengthMask.intersection(self, other)
+
+    def __eq__(self, other):
+        return (isinstance(other, RunLengthMask) and self.shape == other.shape
+                and np.array_equal(self.starts, other.starts) and np.array_equal(self.ends, other.ends))
+
+    def _row_pieces(self):
+        """Runs split on row boundaries as (rows, column starts, column ends)."""
+        width = self.shape[1]
+        first, last = self.starts // width, (self.ends - 1) // width
+        counts = last - first + 1
+        run = np.repeat(np.arange(len(self.starts)), counts)
+        rows = first[run] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        starts = np.maximum(self.starts[run], rows * width) - rows * width
+        ends = np.minimum(self.ends[run], (rows + 1) * width) - rows * width
+        return rows, starts, ends
+
+    def resize_nearest(self, height, width):
+        """Nearest neighbor resize without decoding, picks source pixel floor(i * size / new_size)
+           like tf.image.resize_images with NEAREST_NEIGHBOR."""
+        source_height, source_width = self.shape
+        source_rows = np.minimum(np.arange(height) * source_height // height, source_height - 1)
+        source_columns = np.minimum(np.arange(width) * source_width // width, source_width - 1)
+
+        rows, starts, ends = self._row_pieces()
+        first = np.searchsorted(source_rows, rows, side='left')
+        counts = np.searchsorted(source_rows, rows, side='right') - first
+        piece = np.repeat(np.arange(len(rows)), counts)
+        new_rows = first[piece] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        new_starts = np.searchsorted(source_columns, starts[piece], side='left')
+        new_ends = np.searchsorted(source_columns, ends[piece], side='left')
+        order = np.lexsort((new_starts, new_rows))
+        new_starts = new_rows[order] * width + new_starts[order]
+        new_ends = new_rows[order] * width + new_ends[order]
+        return RunLengthMask((height, width), *_normalize(new_starts, new_ends))
+
+    def to_bytes(self):
+        dtype = np.uint32 if self.shape[0] * self.shape[1] < 2 ** 32 else np.uint64
+        runs = np.empty(2 * len(self.starts), dtype=dtype)
+        runs[0::2], runs[1::2] = self.starts, self.ends
+        header = struct.pack(HEADER, self.shape[0], self.shape[1], len(self.starts), np.dtype(dtype).char.encode())
+        return header + runs.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        height, width, count, dtype = struct.unpack_from(HEADER, data)
+        runs = np.frombuffer(data, dtype=np.dtype(dtype.decode()), count=2 * count, offset=struct.calcsize(HEADER))
+        return cls((height, width), runs[0::2], runs[1::2])
+
+    def __repr__(self):
+        return f"<RunLengthMask shape: {self.shape}, runs: {len(self.starts)}, area: {self.area}>"
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+
+SHARD_SIZE = 256
+INDEX_FILE = "index.json"
+
+
+def source_digest(path):
+    """Cheap digest of source file, changes whenever file is rewritten."""
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ShardView(Mapping):
+    """Read only mapping of keys to memory mapped arrays, nothing is read until it's accessed."""
+
+    def __init__(self, cache, keys):
+        self.cache = cache
+        self.ordered_keys = list(keys)
+        self.key_set = set(self.ordered_keys)
+
+    def __getitem__(self, key):
+        if key not in self.key_set:
+            raise KeyError(key)
+        return self.cache[key]
+
+    def __iter__(self):
+        return iter(self.ordered_keys)
+
+    def __len__(self):
+        return len(self.ordered_keys)
+
+
+class ShardCache:
+    """Arrays of the same shape stored as rows of fixed size .npy shards, opened memory mapped.
+       index.json maps key to (shard, row, source digest). Changed sources overwrite their row,
+       new ones are appended to the last shard, so cache grows with dataset without rewriting it.
+       Cache made for different shape or dtype is dropped."""
+
+    def __init__(self, directory, shape, dtype=np.float32, shard_size=SHARD_SIZE):
+        self.directory = directory
+        self.layout = {"shape": list(shape), "dtype": np.dtype(dtype).str, "shard_size": shard_size}
+        self.readers = {}
+        self.writers = {}
+
+        self.index = self._load_index()
+        if self.index is None or self.index["layout"] != self.layout:
+            shutil.rmtree(directory, ignore_errors=True)
+            self.index = {"layout": self.layout, "rows": 0, "entries": {}}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f"shard_{shard:05d}.npy")
+
+    def _writer(self, shard):
+        if shard not in self.writers:
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                self.writers[shard] = np.load(path, mmap_mode="r+")
+            else:
+                self.writers[shard] = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=np.dtype(self.layout["dtype"]),
+                    shape=(self.layout["shard_size"],) + tuple(self.layout["shape"]))
+        return self.writers[shard]
+
+    def _reader(self, shard):
+        if shard not in self.readers:
+            self.readers[shard] = np.load(self._shard_path(shard), mmap_mode="r")
+        return self.readers[shard]
+
+    def stale(self, files):
+        """Keys of files (key -> source path) which are missing or changed since they were cached."""
+        entries = self.index["entries"]
+        return [key for key, path in files.items()
+                if key not in entries or entries[key][2] != source_digest(path)]
+
+    def put(self, key, path, array):
+        entry = self.index["entries"].get(key)
+        if entry is None:
+            shard, row = divmod(self.index["rows"], self.layout["shard_size"])
+            self.index["rows"] += 1
+        else:
+            shard, row = entry[:2]
+        self._writer(shard)[row] = array
+        self.index["entries"][key] = [shard, row, source_digest(path)]
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+        self.writers = {}
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def __getitem__(self, key):
+        shard, row, _ = self.index["entries"][key]
+        return self._reader(shard)[row]
+
+    def __contains__(self, key):
+        return key in self.index["entries"]
+
+    def view(self, keys):
+        return ShardView(self, keys)
@@ -0,0 +1,138 @@
+import struct
+import zlib
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+LOCAL_SIGNATURE = 0x04034b50
+DESCRIPTOR_SIGNATURE = 0x08074b50
+# central directory and end records, nothing after them is needed when streaming
+END_SIGNATURES = (0x02014b50, 0x06064b50, 0x07064b50, 0x06054b50)
+STORED = 0
+DEFLATED = 8
+ENCRYPTED = 0x01
+HAS_DESCRIPTOR = 0x08
+UTF8_NAME = 0x800
+ZIP64_EXTRA = 0x0001
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipStreamError(IOError):
+    pass
+
+
+class _Stream:
+    """Reads from iterator of byte chunks, e.g. requests iter_content."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size=CHUNK_SIZE):
+        """Up to size bytes, empty at the end of stream."""
+        if len(self.buffer) == 0:
+            self.buffer = next(self.chunks, b"")
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_exact(self, size):
+        parts = []
+        while size > 0:
+            data = self.read(size)
+            if len(data) == 0:
+                raise ZipStreamError("Unexpected end of zip stream")
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def _zip64_sizes(extra, size, compressed_size):
+    """Sizes from zip64 extra field, they are there only for fields set to 0xffffffff in header.
+       Returns (size, compressed_size, zip64)."""
+    position = 0
+    while position + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, position)
+        if header_id == ZIP64_EXTRA:
+            values = list(struct.unpack_from(f"<{length // 8}Q", extra, position + 4))
+            if size == 0xffffffff and values:
+                size = values.pop(0)
+            if compressed_size == 0xffffffff and values:
+                compressed_size = values.pop(0)
+            return size, compressed_size, True
+        position += 4 + length
+    return size, compressed_size, False
+
+
+def _entry_data(stream, name, method, size, crc, descriptor, zip64):
+    checksum = 0
+    if method == DEFLATED:
+        # deflate stream knows where it ends, so sizes aren't needed even with data descriptor
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            data = stream.read()
+            if len(data) == 0:
+                raise ZipStreamError(f"Unexpected end of zip stream in {name}")
+            data = decompressor.decompress(data)
+            checksum = zlib.crc32(data, checksum)
+            yield data
+        stream.unread(decompressor.unused_data)
+    else:
+        remaining = size
+        while remaining > 0:
+            data = stream.read(min(remaining, CHUNK_SIZE))
+            if len(data) == 0:
+                raise ZipStreamError(f"Unexpected end of zip stream in {name}")
+            remaining -= len(data)
+            checksum = zlib.crc32(data, checksum)
+            yield data
+
+    if descriptor:
+        # signature of data descriptor is optional
+        crc, = struct.unpack("<I", stream.read_exact(4))
+        if crc == DESCRIPTOR_SIGNATURE:
+            crc, = struct.unpack("<I", stream.read_exact(4))
+        stream.read_exact(16 if zip64 else 8)
+    if checksum != crc:
+        raise ZipStreamError(f"CRC of {name} doesn't match")
+
+
+def iter_zip_entries(chunks, expected_size=None):
+    """Reads zip archive while it's streaming in, from local headers only.
+       Yields (name, data) for every entry, data yields decompressed chunks and has to be
+       consumed before the next entry is read, it is skipped otherwise.
+       Stored entries with sizes only in data descriptor can't be delimited from stream alone,
+       their size is taken from expected_size(name)."""
+    stream = _Stream(chunks)
+    while True:
+        signature_data = stream.read_exact(4)
+        signature, = struct.unpack("<I", signature_data)
+        if signature in END_SIGNATURES:
+            return
+        if signature != LOCAL_SIGNATURE:
+            raise ZipStreamError(f"Unexpected zip record {signature:#x}")
+
+        (_, _, flags, method, _, _, crc, compressed_size, size, name_length,
+         extra_length) = LOCAL_HEADER.unpack(signature_data + stream.read_exact(LOCAL_HEADER.size - 4))
+        name = stream.read_exact(name_length).decode("utf-8" if flags & UTF8_NAME else "cp437")
+        size, compressed_size, zip64 = _zip64_sizes(stream.read_exact(extra_length), size, compressed_size)
+
+        if flags & ENCRYPTED:
+            raise ZipStreamError(f"{name} is encrypted")
+        if method not in (STORED, DEFLATED):
+            raise ZipStreamError(f"Compression method {method} of {name} isn't supported")
+
+        descriptor = bool(flags & HAS_DESCRIPTOR)
+        if descriptor:
+            crc = None
+            if method == STORED:
+                size = expected_size(name) if expected_size is not None else None
+                if size is None:
+                    raise ZipStreamError(f"Size of stored {name} isn't known")
+        elif method == STORED:
+            size = compressed_size
+
+        data = _entry_data(stream, name, method, size, crc, descriptor, zip64)
+        yield name, data
+        for _ in data:
+            pass